@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+"""Cold and warm latency, stage times, throughput and peak RSS of the Lambda handlers.
+
+    python benchmarks/bench_handlers.py --rows 150 100000 1000000 --output results.json
+    python benchmarks/bench_handlers.py --rows 150 100000 --baseline results.json
+
+Every (handler, rows) pair runs in a fresh interpreter, so the first invocation is
+a real cold start: the handler module is imported and then invoked --invocations
+times, the first invocation is the cold one and the rest are warm. S3 is moto
+running inside that interpreter, or any S3 compatible endpoint given with
+--endpoint-url (a moto server, MinIO, ...) which keeps moto's own imports and
+memory out of the import times and the peak RSS. Data sets are synthetic Iris:
+the three species drawn from normal distributions with the Iris per class means
+and standard deviations, scaled to any number of rows.
+
+Handlers:
+    training          training.handler, a full training run on the data set
+    inference         inference.handler without an event, scores a 30% sample
+    inference-stream  inference.handler with a "stream" event over the whole data set
+
+The inference model is trained once on --model-rows rows, the Iris size by
+default, and baked into the working directory the way the inference image build
+does, so inference time scales with the scored rows and not the reference set.
+Stage timers wrap module functions once the handler module is imported, modules
+the handler would import lazily (streaming) are imported at that point instead.
+"""
+import argparse
+import importlib
+import json
+import math
+import os
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BUCKET = "cdk-ml-pipeline-iris"
+DATA_KEY = "data/Iris.csv"
+RESULTS_BUCKET = "inference-results"
+FEATURE_COLUMNS = ["SepalLengthCm", "SepalWidthCm", "PetalLengthCm", "PetalWidthCm"]
+
+# per species mean and standard deviation of the four features in the Iris data set
+SPECIES = {
+    "Iris-setosa": ([5.006, 3.428, 1.462, 0.246], [0.352, 0.379, 0.174, 0.105]),
+    "Iris-versicolor": ([5.936, 2.770, 4.260, 1.326], [0.516, 0.314, 0.470, 0.198]),
+    "Iris-virginica": ([6.588, 2.974, 5.552, 2.026], [0.636, 0.322, 0.552, 0.275])
+}
+
+HANDLERS = {
+    "training": {
+        "source_dirs": ["training_image_asset", "common"],
+        "module": "training",
+        "event": {},
+        "rows_scored": lambda rows: rows,
+        "stages": [
+            "pandas:read_csv",
+            "training:train_test_split",
+            "training:KNeighborsClassifier.fit",
+            "training:KNeighborsClassifier.predict",
+            "model_artifact:export_knn",
+            "training:upload_model",
+            "training:training_result"
+        ]
+    },
+    "inference": {
+        "source_dirs": ["inference_lambda", "common"],
+        "module": "inference",
+        "event": {},
+        "rows_scored": lambda rows: math.ceil(rows * 0.3),
+        "stages": [
+            "inference:load_dataset",
+            "inference:load_model",
+            "batch:predict_batch",
+            "inference:prediction_csv"
+        ]
+    },
+    "inference-stream": {
+        "source_dirs": ["inference_lambda", "common"],
+        "module": "inference",
+        "event": {"stream": {"bucket": BUCKET, "key": DATA_KEY, "format": "csv", "output_key": "bench/prediction.csv"}},
+        "rows_scored": lambda rows: rows,
+        "stages": [
+            "inference:load_model",
+            "streaming:_csv_block",
+            "batch:predict_batch",
+            "streaming:_format_csv",
+            "streaming:MultipartWriter._upload_part"
+        ]
+    }
+}
+
+MiB = 1024 * 1024
+
+
+def write_dataset(path, rows, seed=0, chunk_rows=100000):
+    """Write an Iris shaped CSV of rows rows, the classes in equal proportions."""
+    # imported here, the workers must not load anything the handlers would import
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    names = list(SPECIES)
+    means = np.array([SPECIES[name][0] for name in names])
+    stds = np.array([SPECIES[name][1] for name in names])
+    with open(path, "w") as stream:
+        stream.write("Id," + ",".join(FEATURE_COLUMNS) + ",Species\n")
+        for start in range(0, rows, chunk_rows):
+            count = min(chunk_rows, rows - start)
+            species = rng.integers(0, len(names), count)
+            features = np.clip(np.round(rng.normal(means[species], stds[species]), 1), 0.1, None)
+            stream.write("".join(
+                "%d,%.1f,%.1f,%.1f,%.1f,%s\n" % (start + row + 1, *features[row], names[species[row]])
+                for row in range(count)
+            ))
+
+
+def current_rss_bytes():
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def peak_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class StageTimer:
+    """Wraps module level functions and class methods to add up the time spent in them."""
+
+    def __init__(self):
+        self.seconds = {}
+
+    def install(self, spec):
+        module_name, path = spec.split(":")
+        owner = importlib.import_module(module_name)
+        *parents, name = path.split(".")
+        for parent in parents:
+            owner = getattr(owner, parent)
+        original = getattr(owner, name)
+        seconds = self.seconds
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                seconds[spec] = seconds.get(spec, 0.0) + time.perf_counter() - start
+
+        setattr(owner, name, timed)
+
+    def take(self):
+        seconds, self.seconds = self.seconds, {}
+        return seconds
+
+
+def export_model(client, directory):
+    # what inference_image_codebuild/buildspec.yml copies into the image
+    os.makedirs(os.path.join(directory, "model_artifact"), exist_ok=True)
+    client.download_file(BUCKET, "models/latest/finalized_model.sav", os.path.join(directory, "finalized_model.sav"))
+    listing = client.list_objects_v2(Bucket=BUCKET, Prefix="models/latest/artifact/")
+    for item in listing.get("Contents", []):
+        name = item["Key"][len("models/latest/artifact/"):]
+        client.download_file(BUCKET, item["Key"], os.path.join(directory, "model_artifact", name))
+
+
+def set_environment(endpoint_url=None):
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    os.environ["INFERENCE_RESULTS_BUCKET"] = RESULTS_BUCKET
+    if endpoint_url:
+        os.environ["AWS_ENDPOINT_URL"] = endpoint_url
+
+
+def upload_dataset(dataset):
+    import boto3
+    client = boto3.client("s3")
+    for bucket in [BUCKET, RESULTS_BUCKET]:
+        try:
+            client.create_bucket(Bucket=bucket)
+        except client.exceptions.BucketAlreadyOwnedByYou:
+            pass
+    client.upload_file(dataset, BUCKET, DATA_KEY)
+
+
+def run_worker(spec):
+    """Runs in the fresh interpreter, invokes one handler and writes its measurements."""
+    set_environment(spec.get("endpoint_url"))
+    if not spec.get("endpoint_url"):
+        # moto has to live in this interpreter, it imports boto3 before the handler does
+        from moto import mock_aws
+        mock_aws().start()
+        upload_dataset(spec["dataset"])
+
+    handler_spec = HANDLERS[spec["handler"]]
+    for source_dir in handler_spec["source_dirs"]:
+        sys.path.insert(0, os.path.join(ROOT, source_dir))
+    os.chdir(spec["cwd"])
+
+    baseline_rss = current_rss_bytes()
+    start = time.perf_counter()
+    module = importlib.import_module(handler_spec["module"])
+    import_seconds = time.perf_counter() - start
+
+    timer = StageTimer()
+    for stage in handler_spec["stages"]:
+        timer.install(stage)
+
+    invocations = []
+    for _ in range(spec["invocations"]):
+        start = time.perf_counter()
+        module.handler(json.loads(json.dumps(handler_spec["event"])), None)
+        invocations.append({"seconds": time.perf_counter() - start, "stages": timer.take()})
+
+    if spec.get("export_model_to"):
+        import boto3
+        export_model(boto3.client("s3"), spec["export_model_to"])
+
+    with open(spec["result"], "w") as stream:
+        json.dump({
+            "import_seconds": import_seconds,
+            "invocations": invocations,
+            "baseline_rss_bytes": baseline_rss,
+            "peak_rss_bytes": peak_rss_bytes()
+        }, stream)
+
+
+def run_handler(handler, dataset, cwd, invocations, workdir, endpoint_url=None, export_model_to=None):
+    result_path = os.path.join(workdir, "result.json")
+    spec = {
+        "handler": handler,
+        "dataset": dataset,
+        "cwd": cwd,
+        "invocations": invocations,
+        "result": result_path,
+        "endpoint_url": endpoint_url,
+        "export_model_to": export_model_to
+    }
+    if endpoint_url:
+        # an external endpoint is loaded from here, the worker imports nothing before the handler
+        set_environment(endpoint_url)
+        upload_dataset(dataset)
+    # the handlers log every invocation, keep that out of the report
+    with open(os.path.join(workdir, handler + ".log"), "a") as log:
+        subprocess.run([sys.executable, os.path.abspath(__file__), "--worker", json.dumps(spec)],
+            stdout=log, stderr=subprocess.STDOUT, check=True)
+    with open(result_path) as stream:
+        return json.load(stream)
+
+
+def summarize(handler, rows, measured):
+    invocations = measured["invocations"]
+    rows_scored = HANDLERS[handler]["rows_scored"](rows)
+    cold = invocations[0]
+    warm = invocations[1:]
+    warm_seconds = statistics.median(invocation["seconds"] for invocation in warm) if warm else None
+    return {
+        "handler": handler,
+        "rows": rows,
+        "rows_scored": rows_scored,
+        "import_seconds": measured["import_seconds"],
+        # a cold start pays for the handler module import and the first invocation
+        "cold_seconds": measured["import_seconds"] + cold["seconds"],
+        "warm_seconds": warm_seconds,
+        "cold_rows_per_second": rows_scored / cold["seconds"] if cold["seconds"] else None,
+        "warm_rows_per_second": rows_scored / warm_seconds if warm_seconds else None,
+        "cold_stages": cold["stages"],
+        "warm_stages": {
+            stage: statistics.median(invocation["stages"].get(stage, 0.0) for invocation in warm)
+            for stage in cold["stages"]
+        } if warm else None,
+        "baseline_rss_mb": measured["baseline_rss_bytes"] / MiB,
+        "peak_rss_mb": measured["peak_rss_bytes"] / MiB,
+        "invocation_seconds": [invocation["seconds"] for invocation in invocations]
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Results slower than the same (handler, rows) of baseline by more than tolerance."""
+    previous = {(result["handler"], result["rows"]): result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        before = previous.get((result["handler"], result["rows"]))
+        if before is None:
+            continue
+        for metric in ["cold_seconds", "warm_seconds", "peak_rss_mb"]:
+            if result.get(metric) and before.get(metric) and result[metric] > before[metric] * (1 + tolerance):
+                regressions.append({
+                    "handler": result["handler"],
+                    "rows": result["rows"],
+                    "metric": metric,
+                    "baseline": before[metric],
+                    "current": result[metric]
+                })
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, nargs="+", default=[150, 10000, 100000])
+    parser.add_argument("--handlers", nargs="+", choices=list(HANDLERS), default=list(HANDLERS))
+    parser.add_argument("--invocations", type=int, default=3, help="per interpreter, the first one is cold")
+    parser.add_argument("--model-rows", type=int, default=150, help="rows the inference model is trained on")
+    parser.add_argument("--endpoint-url", help="S3 compatible endpoint to use instead of in-process moto")
+    parser.add_argument("--workdir", help="keep data sets, models and handler logs here")
+    parser.add_argument("--output", help="write the results as JSON to this path")
+    parser.add_argument("--baseline", help="results JSON of an earlier run to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown against the baseline")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(json.loads(args.worker))
+        return
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="bench-handlers-")
+    os.makedirs(workdir, exist_ok=True)
+
+    model_dir = os.path.join(workdir, "model")
+    if any(handler != "training" for handler in args.handlers):
+        shutil.rmtree(model_dir, ignore_errors=True)
+        os.makedirs(model_dir)
+        model_dataset = os.path.join(workdir, "model-" + str(args.model_rows) + ".csv")
+        write_dataset(model_dataset, args.model_rows, seed=1)
+        run_handler("training", model_dataset, workdir, 1, workdir, args.endpoint_url, export_model_to=model_dir)
+
+    results = []
+    for rows in args.rows:
+        dataset = os.path.join(workdir, "iris-" + str(rows) + ".csv")
+        if not os.path.exists(dataset):
+            write_dataset(dataset, rows)
+        for handler in args.handlers:
+            cwd = workdir if handler == "training" else model_dir
+            measured = run_handler(handler, dataset, cwd, args.invocations, workdir, args.endpoint_url)
+            result = summarize(handler, rows, measured)
+            results.append(result)
+            print("{handler:>16} rows={rows:>9} import={import_seconds:7.3f}s cold={cold_seconds:8.3f}s "
+                "warm={warm:>8}s {rate:>12} rows/s peak_rss={peak_rss_mb:7.1f}MiB".format(
+                    warm="%.3f" % result["warm_seconds"] if result["warm_seconds"] is not None else "-",
+                    rate="%.0f" % result["warm_rows_per_second"] if result["warm_rows_per_second"] else "-",
+                    **result))
+
+    report = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "cpus": len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count(),
+        "s3": args.endpoint_url or "moto",
+        "invocations": args.invocations,
+        "model_rows": args.model_rows,
+        "results": results
+    }
+    if args.output:
+        with open(args.output, "w") as stream:
+            json.dump(report, stream, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as stream:
+            regressions = compare(results, json.load(stream), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION {handler} rows={rows} {metric}: {baseline:.3f} -> {current:.3f}".format(**regression))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
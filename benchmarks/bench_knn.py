@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""Throughput of the NumPy KNN engine against sklearn across batch and reference sizes.
+
+    python benchmarks/bench_knn.py --reference-sizes 1000 100000 --batch-sizes 100 10000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "common"))
+
+import knn
+
+
+def best_time(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--reference-sizes", type=int, nargs="+", default=[150, 10000, 100000])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 100, 10000])
+    parser.add_argument("--features", type=int, default=4)
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--n-jobs", type=int, default=knn.default_n_jobs())
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--skip-sklearn", action="store_true")
+    parser.add_argument("--output", help="write the results as JSON to this path")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    results = []
+    for n_reference in args.reference_sizes:
+        reference = rng.normal(size=(n_reference, args.features))
+        labels = rng.integers(0, 3, n_reference)
+        engines = {
+            "numpy-float64": knn.KnnPredictor(reference, labels, [0, 1, 2], n_neighbors=args.k),
+            "numpy-float32": knn.KnnPredictor(reference.astype(np.float32), labels, [0, 1, 2], n_neighbors=args.k, dtype=np.float32),
+            "numpy-float32-threads": knn.KnnPredictor(reference.astype(np.float32), labels, [0, 1, 2], n_neighbors=args.k, dtype=np.float32, n_jobs=args.n_jobs)
+        }
+        if not args.skip_sklearn:
+            from sklearn.neighbors import KNeighborsClassifier
+            # "auto" picks a KD-tree for low dimensional data, "brute" is the like for like comparison
+            engines["sklearn-brute"] = KNeighborsClassifier(n_neighbors=args.k, algorithm="brute").fit(reference, labels)
+            engines["sklearn-auto"] = KNeighborsClassifier(n_neighbors=args.k).fit(reference, labels)
+
+        for batch_size in args.batch_sizes:
+            queries = rng.normal(size=(batch_size, args.features))
+            for name, engine in engines.items():
+                seconds = best_time(lambda: engine.predict(queries), args.repeat)
+                result = {
+                    "engine": name,
+                    "reference_rows": n_reference,
+                    "batch_rows": batch_size,
+                    "seconds": seconds,
+                    "rows_per_second": batch_size / seconds if seconds else None
+                }
+                results.append(result)
+                print("{engine:>22} reference={reference_rows:>9} batch={batch_rows:>7} {seconds:10.5f}s {rows_per_second:14.0f} rows/s".format(**result))
+
+    if args.output:
+        with open(args.output, "w") as stream:
+            json.dump({"k": args.k, "features": args.features, "n_jobs": args.n_jobs, "results": results}, stream, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,7 @@
+import glob
+import shutil
+
+import jsii
 import aws_cdk as cdk
 from aws_cdk import (
     Duration,
@@ -9,10 +13,41 @@ from aws_cdk import (
     aws_s3_deployment as s3deploy,
     aws_stepfunctions as sfn,
     aws_stepfunctions_tasks as tasks,
-    aws_codebuild as codebuild
+    aws_codebuild as codebuild,
+    aws_events as events,
+    aws_events_targets as events_targets
 )
 from constructs import Construct
 
+# Modules of common/ the zip Lambdas in lambdas/ import, copied next to them
+LAMBDA_SHARED_MODULES = ["common/instrumentation.py", "common/s3_io.py"]
+
+
+@jsii.implements(cdk.ILocalBundling)
+class CopySources:
+    """Bundles an asset by copying files into the output directory, no Docker needed."""
+
+    def __init__(self, sources):
+        self.sources = sources
+
+    def try_bundle(self, output_dir, *, image, **options):
+        for source in self.sources:
+            shutil.copy(source, output_dir)
+        return True
+
+
+def lambda_code():
+    sources = sorted(glob.glob("lambdas/*.py")) + LAMBDA_SHARED_MODULES
+    return aws_lambda.Code.from_asset("./lambdas",
+        bundling=cdk.BundlingOptions(
+            image=aws_lambda.Runtime.PYTHON_3_9.bundling_image,
+            local=CopySources(sources)
+        ),
+        # hash what is shipped, so that a change to a shared module is deployed too
+        asset_hash_type=cdk.AssetHashType.OUTPUT
+    )
+
+
 class CdkMlPipelineStack(Stack):
 
     def __init__(self, scope: Construct, construct_id: str, **kwargs) -> None:
@@ -35,7 +70,9 @@ class CdkMlPipelineStack(Stack):
             self, "training-lambda",
             function_name="training-lambda",
             code=aws_lambda.DockerImageCode.from_image_asset(
-                "./training_image_asset"
+                ".",
+                file="training_image_asset/Dockerfile",
+                exclude=["cdk.out", ".git", ".venv", "tests", "inference_lambda", "lambdas", "*_codebuild"]
             ),
             memory_size=10240,
             timeout=Duration.seconds(900)
@@ -68,7 +105,7 @@ class CdkMlPipelineStack(Stack):
 
 # inference_image_codebuild project
         inference_image_codebuild_bucket_deployment = s3deploy.BucketDeployment(self, "inference-image-codebuild-artifacts-bucket-deployment",
-            sources=[s3deploy.Source.asset("inference_image_codebuild"), s3deploy.Source.asset("inference_lambda")],
+            sources=[s3deploy.Source.asset("inference_image_codebuild"), s3deploy.Source.asset("inference_lambda"), s3deploy.Source.asset("common")],
             destination_bucket=codebuild_artifacts_bucket,
             destination_key_prefix="inference-image-codebuild"
         )
@@ -138,7 +175,14 @@ class CdkMlPipelineStack(Stack):
             statements=[
                 aws_iam.PolicyStatement(
                     actions=["lambda:GetFunction", "lambda:CreateFunction","lambda:UpdateFunctionCode"],
-                    resources=["arn:aws:lambda:"+cdk.Aws.REGION+":"+cdk.Aws.ACCOUNT_ID+":function:inference-lambda"]
+                    resources=[
+                        "arn:aws:lambda:"+cdk.Aws.REGION+":"+cdk.Aws.ACCOUNT_ID+":function:inference-lambda",
+                        "arn:aws:lambda:"+cdk.Aws.REGION+":"+cdk.Aws.ACCOUNT_ID+":function:online-inference-lambda"
+                    ]
+                ),
+                aws_iam.PolicyStatement(
+                    actions=["lambda:GetFunctionUrlConfig", "lambda:CreateFunctionUrlConfig"],
+                    resources=["arn:aws:lambda:"+cdk.Aws.REGION+":"+cdk.Aws.ACCOUNT_ID+":function:online-inference-lambda"]
                 ),
                 aws_iam.PolicyStatement(
                     actions=["iam:GetRole", "iam:PassRole"],
@@ -172,7 +216,7 @@ class CdkMlPipelineStack(Stack):
             function_name="codebuild-helper-function",
             runtime=aws_lambda.Runtime.PYTHON_3_9,
             handler="codebuild_helper_lambda.handler",
-            code=aws_lambda.Code.from_asset("./lambdas"),
+            code=lambda_code(),
             timeout=cdk.Duration.minutes(10)
         )
 
@@ -182,27 +226,58 @@ class CdkMlPipelineStack(Stack):
 # Step function to tie CodeBuild steps together to retrain
         train_task = tasks.LambdaInvoke(self, "train",
             lambda_function=training_lambda,
-            result_path = sfn.JsonPath.string_at("$.result")
+            result_path = sfn.JsonPath.string_at("$.training")
         )
 
+# CodeBuild steps only start their build and hand over a task token, the state machine
+# waits without a Lambda running until the build state change event completes the task
         inference_image_update_task= tasks.LambdaInvoke(self, "inference-image-update",
             lambda_function=codebuild_helper_lambda,
+            integration_pattern=sfn.IntegrationPattern.WAIT_FOR_TASK_TOKEN,
             payload=sfn.TaskInput.from_object({
-                "project_name": inference_image_codebuild_project.project_name
+                "project_name": inference_image_codebuild_project.project_name,
+                "task_token": sfn.JsonPath.task_token
             }),
+            timeout=Duration.hours(1),
             result_path = sfn.JsonPath.string_at("$.result")
         )
 
         create_or_update_inference_lambda_task= tasks.LambdaInvoke(self, "create-or-update-inference-lambda",
             lambda_function=codebuild_helper_lambda,
+            integration_pattern=sfn.IntegrationPattern.WAIT_FOR_TASK_TOKEN,
             payload=sfn.TaskInput.from_object({
-                "project_name": create_or_update_inference_lambda_project.project_name
+                "project_name": create_or_update_inference_lambda_project.project_name,
+                "task_token": sfn.JsonPath.task_token
             }),
+            timeout=Duration.hours(1),
             result_path = sfn.JsonPath.string_at("$.result")
         )
 
-        train_task.next(inference_image_update_task)
+# Record the content hash of the deployed model, the next run compares against it
+        mark_model_in_use_task = tasks.CallAwsService(self, "mark-model-in-use",
+            service="s3",
+            action="putObject",
+            parameters={
+                "Bucket": "cdk-ml-pipeline-iris",
+                "Key": "models/in-use/model_hash",
+                "Body": sfn.JsonPath.string_at("$.training.Payload.model_hash")
+            },
+            iam_resources=["arn:aws:s3:::cdk-ml-pipeline-iris/models/in-use/*"],
+            result_path = sfn.JsonPath.DISCARD
+        )
+
+# Skip the image rebuild and redeploy when training produced the model that is already in use
+        model_changed_choice = sfn.Choice(self, "model-changed")
+        model_unchanged = sfn.Succeed(self, "model-unchanged")
+
+        train_task.next(model_changed_choice)
+        model_changed_choice.when(
+            sfn.Condition.string_equals_json_path("$.training.Payload.model_hash", "$.training.Payload.in_use_hash"),
+            model_unchanged
+        )
+        model_changed_choice.otherwise(inference_image_update_task)
         inference_image_update_task.next(create_or_update_inference_lambda_task)
+        create_or_update_inference_lambda_task.next(mark_model_in_use_task)
 
         retrain_definition = train_task
 
@@ -210,3 +285,113 @@ class CdkMlPipelineStack(Stack):
             definition=retrain_definition,
             state_machine_name="retrain-pipeline"
         )
+
+# CodeBuild callback Lambda completes the waiting retrain-pipeline task when a build finishes
+        codebuild_callback_lambda = aws_lambda.Function(
+            self, "codebuild-callback-function",
+            function_name="codebuild-callback-function",
+            runtime=aws_lambda.Runtime.PYTHON_3_9,
+            handler="codebuild_helper_lambda.build_state_change_handler",
+            code=lambda_code(),
+            timeout=cdk.Duration.seconds(30)
+        )
+
+        retrain_sfn.grant_task_response(codebuild_callback_lambda)
+
+        events.Rule(self, "codebuild-state-change-rule",
+            event_pattern=events.EventPattern(
+                source=["aws.codebuild"],
+                detail_type=["CodeBuild Build State Change"],
+                detail={
+                    "build-status": ["SUCCEEDED", "FAILED", "FAULT", "STOPPED", "TIMED_OUT"],
+                    "project-name": [
+                        inference_image_codebuild_project.project_name,
+                        create_or_update_inference_lambda_project.project_name
+                    ]
+                }
+            ),
+            targets=[events_targets.LambdaFunction(codebuild_callback_lambda)]
+        )
+
+# Splitter and merge Lambda for the batch inference state machine
+        batch_inference_environment = {
+            "INFERENCE_RESULTS_BUCKET": inference_results_bucket.bucket_name
+        }
+
+        batch_inference_split_lambda = aws_lambda.Function(
+            self, "batch-inference-split-function",
+            function_name="batch-inference-split-function",
+            runtime=aws_lambda.Runtime.PYTHON_3_9,
+            handler="batch_inference_lambda.split_handler",
+            code=lambda_code(),
+            environment=batch_inference_environment,
+            timeout=cdk.Duration.minutes(1)
+        )
+
+        batch_inference_merge_lambda = aws_lambda.Function(
+            self, "batch-inference-merge-function",
+            function_name="batch-inference-merge-function",
+            runtime=aws_lambda.Runtime.PYTHON_3_9,
+            handler="batch_inference_lambda.merge_handler",
+            code=lambda_code(),
+            environment=batch_inference_environment,
+            memory_size=1024,
+            timeout=cdk.Duration.minutes(15)
+        )
+
+        for batch_inference_lambda in [batch_inference_split_lambda, batch_inference_merge_lambda]:
+            batch_inference_lambda.role.add_to_policy(model_artifacts_bucket_read_only_statement)
+            inference_results_bucket.grant_read_write(batch_inference_lambda)
+
+# Inference Lambda is created by the create_or_update_inference_lambda CodeBuild project, reference it by name
+        inference_lambda = aws_lambda.Function.from_function_arn(self, "inference-lambda",
+            "arn:aws:lambda:"+cdk.Aws.REGION+":"+cdk.Aws.ACCOUNT_ID+":function:inference-lambda"
+        )
+
+# Step function to fan out batch inference over byte range shards of the input object
+        split_task = tasks.LambdaInvoke(self, "split",
+            lambda_function=batch_inference_split_lambda,
+            payload_response_only=True,
+            result_path = "$.split"
+        )
+
+        # only what merge reads is kept of every shard's response
+        score_shard_task = tasks.LambdaInvoke(self, "score-shard",
+            lambda_function=inference_lambda,
+            payload_response_only=True,
+            result_selector={
+                "output_s3.$": "$.output_s3",
+                "rows.$": "$.rows"
+            }
+        )
+        score_shard_task.add_retry(errors=["Lambda.TooManyRequestsException"],
+            interval=Duration.seconds(2),
+            backoff_rate=2,
+            max_attempts=6
+        )
+
+        score_shards_map = sfn.Map(self, "score-shards",
+            items_path="$.split.shards",
+            max_concurrency=int(self.node.try_get_context("batch_inference_max_concurrency") or 20),
+            # the results replace the shard events, the state never holds both lists
+            result_path="$.split.shards"
+        )
+        score_shards_map.iterator(score_shard_task)
+
+        merge_task = tasks.LambdaInvoke(self, "merge",
+            lambda_function=batch_inference_merge_lambda,
+            payload=sfn.TaskInput.from_object({
+                "parts": sfn.JsonPath.list_at("$.split.shards"),
+                "output": sfn.JsonPath.object_at("$.split.output")
+            }),
+            payload_response_only=True,
+            result_path = "$.result"
+        )
+
+        split_task.next(score_shards_map)
+        score_shards_map.next(merge_task)
+
+        batch_inference_sfn = sfn.StateMachine(self, "batch_inference_sfn",
+            definition=split_task,
+            state_machine_name="batch-inference-pipeline"
+        )
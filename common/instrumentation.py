@@ -0,0 +1,171 @@
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import ContextDecorator
+
+# Stage timers and counters written as CloudWatch embedded metric format (EMF)
+# JSON lines. A Lambda's stdout goes to CloudWatch Logs, which turns every line
+# carrying an "_aws" block into metrics without a PutMetricData call. The values
+# recorded during an invocation are added up per name and written as one line by
+# flush(), with the function name, the model version and whether the invocation
+# was a cold start as dimensions. Locally the same lines can be parsed back from
+# stdout. METRICS_MODE=off turns every call into a no-op.
+
+DEFAULT_NAMESPACE = "CdkMlPipeline"
+MILLISECONDS = "Milliseconds"
+COUNT = "Count"
+BYTES = "Bytes"
+
+# the first invocation of every process is its cold start
+_invocations = 0
+_invocations_lock = threading.Lock()
+
+
+class _Timer(ContextDecorator):
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.start = None
+
+    def _recreate_cm(self):
+        # a fresh timer per decorated call, so that concurrent calls do not share a start
+        return _Timer(self.metrics, self.name)
+
+    def __enter__(self):
+        self.start = self.metrics.clock()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.put(self.name, (self.metrics.clock() - self.start) * 1000, MILLISECONDS)
+        return False
+
+
+class _NoopTimer(ContextDecorator):
+
+    def _recreate_cm(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP_TIMER = _NoopTimer()
+
+
+class Metrics:
+    """Collects the metrics of one invocation and writes them as an EMF line on flush.
+
+    timer(name) is both a context manager and a decorator, count(name, value)
+    adds to a counter. Dimensions are the function name, the model version and
+    "ColdStart" (cold or warm, set by begin()), properties are logged alongside
+    the metrics without being metrics themselves.
+    """
+
+    def __init__(self, namespace=DEFAULT_NAMESPACE, function_name=None, enabled=True, stream=None,
+            clock=time.perf_counter):
+        self.namespace = namespace
+        self.enabled = enabled
+        self.stream = stream
+        self.clock = clock
+        self.dimensions = {"FunctionName": function_name or "local"}
+        self.values = {}
+        self.units = {}
+        self.properties = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_environment(cls, **kwargs):
+        return cls(
+            namespace=os.environ.get("METRICS_NAMESPACE", DEFAULT_NAMESPACE),
+            function_name=os.environ.get("AWS_LAMBDA_FUNCTION_NAME"),
+            enabled=os.environ.get("METRICS_MODE", "emf") != "off",
+            **kwargs
+        )
+
+    def begin(self):
+        """Start an invocation, returning True when it is the cold start of the process."""
+        global _invocations
+        with _invocations_lock:
+            _invocations += 1
+            cold = _invocations == 1
+        if self.enabled:
+            self.dimensions["ColdStart"] = "cold" if cold else "warm"
+        return cold
+
+    def set_dimension(self, name, value):
+        if self.enabled:
+            self.dimensions[name] = str(value)
+
+    def set_property(self, name, value):
+        if self.enabled:
+            self.properties[name] = value
+
+    def timer(self, name):
+        if not self.enabled:
+            return _NOOP_TIMER
+        return _Timer(self, name)
+
+    def count(self, name, value=1, unit=COUNT):
+        if self.enabled:
+            self.put(name, value, unit)
+
+    def put(self, name, value, unit):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.values[name] = self.values.get(name, 0) + value
+            self.units[name] = unit
+
+    def document(self):
+        """The EMF document of what was recorded since the last flush."""
+        with self._lock:
+            values = dict(self.values)
+            units = dict(self.units)
+        document = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": self.namespace,
+                    "Dimensions": [sorted(self.dimensions)],
+                    "Metrics": [{"Name": name, "Unit": units[name]} for name in values]
+                }]
+            }
+        }
+        document.update(self.properties)
+        document.update(self.dimensions)
+        document.update(values)
+        return document
+
+    def flush(self):
+        """Write the recorded metrics as one EMF line and start over, a no-op when nothing was recorded."""
+        if not self.enabled or not (self.values or self.properties):
+            return None
+        document = self.document()
+        print(json.dumps(document, default=str), file=self.stream or sys.stdout, flush=True)
+        with self._lock:
+            self.values = {}
+            self.units = {}
+        self.properties = {}
+        return document
+
+
+def parse_emf(text):
+    """The EMF documents among the lines of text, other log lines are skipped."""
+    documents = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line.startswith("{"):
+            continue
+        try:
+            document = json.loads(line)
+        except ValueError:
+            continue
+        if isinstance(document, dict) and "_aws" in document:
+            documents.append(document)
+    return documents
@@ -0,0 +1,227 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# Vectorized brute force KNN. Distances are computed block by block so that the
+# query x reference distance matrix never exceeds block_bytes: euclidean distances
+# use ||q||^2 + ||r||^2 - 2 q.r so the heavy lifting is one BLAS matrix product per
+# block, top-k selection uses repeated argmin for small k and np.argpartition
+# otherwise, and the running top-k is merged across reference blocks. Query shards
+# are spread over a thread pool, BLAS and the NumPy reductions release the GIL so
+# threads scale across cores without the process pools the Lambda runtime cannot
+# offer (there is no /dev/shm for their semaphores).
+#
+# Voting follows KNeighborsClassifier: neighbours are ordered by distance, uniform
+# or 1/distance weights (exact matches take all the weight) and ties between
+# classes go to the lowest class index.
+
+METRICS = ["euclidean", "manhattan"]
+DEFAULT_BLOCK_BYTES = 1024 * 1024
+QUERY_BLOCK_ROWS = 32
+AUGMENT_MIN_QUERIES = 256
+# up to this many neighbours top-k uses repeated argmin instead of argpartition
+SMALL_K = 8
+
+
+class DeadlineExceeded(Exception):
+    """Raised by kneighbors when its deadline passes before the search is done."""
+
+
+def default_n_jobs():
+    return len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+
+
+def _block_scores(queries, reference, reference_norms, metric):
+    # For euclidean this is ||r||^2 - 2 q.r: the squared distance minus the per
+    # query constant ||q||^2, which ranks neighbours the same. queries come scaled
+    # by -2, for large batches both sides also come augmented, queries as [-2q, 1]
+    # and reference as [r, ||r||^2], so that a single matrix product does it all.
+    if metric == "euclidean":
+        scores = queries @ reference.T
+        if reference_norms is not None:
+            scores += reference_norms[None, :]
+        return scores
+    scores = np.empty((queries.shape[0], reference.shape[0]), dtype=queries.dtype)
+    for column in range(0, reference.shape[0], 256):
+        chunk = reference[column:column + 256]
+        scores[:, column:column + 256] = np.abs(queries[:, None, :] - chunk[None, :, :]).sum(axis=2)
+    return scores
+
+
+def _top_k(scores, k):
+    """(values, positions) of the k smallest scores of every row, in no particular order."""
+    if k >= scores.shape[1]:
+        positions = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+        return scores, positions
+    if k <= SMALL_K:
+        # a few argmin passes beat argpartition by a wide margin for small k, and
+        # pick the lowest index among equal scores. scores is a scratch block.
+        rows = np.arange(scores.shape[0])
+        positions = np.empty((scores.shape[0], k), dtype=np.intp)
+        values = np.empty((scores.shape[0], k), dtype=scores.dtype)
+        for neighbor in range(k):
+            nearest = np.argmin(scores, axis=1)
+            positions[:, neighbor] = nearest
+            values[:, neighbor] = scores[rows, nearest]
+            scores[rows, nearest] = np.inf
+        return values, positions
+    positions = np.argpartition(scores, k - 1, axis=1)[:, :k]
+    return np.take_along_axis(scores, positions, axis=1), positions
+
+
+def _sorted_top_k(values, indices, k):
+    # nearest first, ties broken by reference index like sklearn's stable sort
+    order = np.lexsort((indices, values), axis=1)[:, :k]
+    return np.take_along_axis(values, order, axis=1), np.take_along_axis(indices, order, axis=1)
+
+
+def kneighbors(queries, reference, k, metric="euclidean", dtype=np.float64, reference_norms=None,
+        block_bytes=DEFAULT_BLOCK_BYTES, deadline=None):
+    """Return (distances, indices) of the k nearest reference rows of every query, nearest first.
+
+    With a deadline (a time.monotonic() value) the search gives up between
+    reference blocks once it has passed, raising DeadlineExceeded.
+    """
+    if metric not in METRICS:
+        raise ValueError("unsupported metric "+str(metric)+", expected one of "+str(METRICS))
+    queries = np.ascontiguousarray(queries, dtype=dtype)
+    n_queries = queries.shape[0]
+    n_reference = reference.shape[0]
+    k = min(k, n_reference)
+    itemsize = np.dtype(dtype).itemsize
+    # augmenting costs a copy of every reference chunk, only worth it for big batches
+    augment = metric == "euclidean" and n_queries >= AUGMENT_MIN_QUERIES
+    if metric == "euclidean":
+        if reference_norms is None:
+            reference_norms = squared_norms(reference, dtype)
+        scaled_queries = queries * -2
+        if augment:
+            scaled_queries = np.hstack([scaled_queries, np.ones((n_queries, 1), dtype=dtype)])
+    else:
+        scaled_queries = queries
+
+    # A few dozen query rows against as much of the reference set as fits in
+    # block_bytes keeps the scratch block cache resident. The reference set is the
+    # outer loop so a memory mapped or differently typed reference is read and cast
+    # once, the running top-k of every query is merged chunk by chunk.
+    reference_block = max(k, min(n_reference, block_bytes // (itemsize * QUERY_BLOCK_ROWS)))
+    query_block = max(1, block_bytes // (itemsize * reference_block))
+
+    best_values = None
+    best_indices = None
+    for column in range(0, n_reference, reference_block):
+        if deadline is not None and time.monotonic() > deadline:
+            raise DeadlineExceeded("neighbour search stopped at reference row "+str(column)+" of "+str(n_reference))
+        reference_chunk = np.asarray(reference[column:column + reference_block], dtype=dtype)
+        chunk_norms = None
+        if augment:
+            reference_chunk = np.hstack([reference_chunk, reference_norms[column:column + reference_block, None]])
+        elif metric == "euclidean":
+            chunk_norms = reference_norms[column:column + reference_block]
+        chunk_k = min(k, reference_chunk.shape[0])
+        chunk_values = np.empty((n_queries, chunk_k), dtype=dtype)
+        chunk_indices = np.empty((n_queries, chunk_k), dtype=np.intp)
+        for row in range(0, n_queries, query_block):
+            values, positions = _top_k(
+                _block_scores(scaled_queries[row:row + query_block], reference_chunk, chunk_norms, metric), chunk_k
+            )
+            chunk_values[row:row + query_block] = values
+            chunk_indices[row:row + query_block] = positions + column
+
+        if best_values is None:
+            best_values, best_indices = chunk_values, chunk_indices
+        else:
+            best_values, best_indices = _sorted_top_k(
+                np.concatenate([best_values, chunk_values], axis=1),
+                np.concatenate([best_indices, chunk_indices], axis=1),
+                k
+            )
+
+    distances, indices = _sorted_top_k(best_values, best_indices, k)
+    if metric == "euclidean":
+        distances += np.einsum("ij,ij->i", queries, queries)[:, None]
+        np.maximum(distances, 0, out=distances)
+        np.sqrt(distances, out=distances)
+    return distances, indices
+
+
+def squared_norms(reference, dtype=np.float64, block_rows=65536):
+    norms = np.empty(reference.shape[0], dtype=dtype)
+    for row in range(0, reference.shape[0], block_rows):
+        block = np.asarray(reference[row:row + block_rows], dtype=dtype)
+        norms[row:row + block_rows] = np.einsum("ij,ij->i", block, block)
+    return norms
+
+
+def vote(neighbor_labels, distances, n_classes, weights="uniform"):
+    """Class probabilities from the labels (class indices) of each query's neighbours."""
+    if weights == "distance":
+        with np.errstate(divide="ignore"):
+            weight = 1.0 / distances.astype(np.float64)
+        exact = np.isinf(weight)
+        exact_rows = exact.any(axis=1)
+        weight[exact_rows] = exact[exact_rows]
+    elif weights == "uniform":
+        weight = np.ones(neighbor_labels.shape)
+    else:
+        raise ValueError("unsupported weights "+str(weights))
+    proba = np.zeros((neighbor_labels.shape[0], n_classes))
+    rows = np.broadcast_to(np.arange(neighbor_labels.shape[0])[:, None], neighbor_labels.shape)
+    np.add.at(proba, (rows, neighbor_labels), weight)
+    proba /= proba.sum(axis=1, keepdims=True)
+    return proba
+
+
+class KnnPredictor:
+    """Brute force KNN classifier over a (possibly memory mapped) reference set.
+
+    labels are class indices into classes. n_jobs > 1 splits the queries into
+    shards scored concurrently on a thread pool.
+    """
+
+    def __init__(self, reference, labels, classes, n_neighbors=5, weights="uniform", metric="euclidean",
+            dtype=np.float64, n_jobs=1, block_bytes=DEFAULT_BLOCK_BYTES):
+        self.reference = reference
+        self.labels = labels
+        self.classes_ = np.asarray(classes)
+        self.n_neighbors = n_neighbors
+        self.weights = weights
+        self.metric = metric
+        self.dtype = np.dtype(dtype)
+        self.n_jobs = n_jobs
+        self.block_bytes = block_bytes
+        self._reference_norms = None
+        self._executor = None
+
+    def reference_norms(self):
+        if self.metric == "euclidean" and self._reference_norms is None:
+            self._reference_norms = squared_norms(self.reference, self.dtype)
+        return self._reference_norms
+
+    def _kneighbors(self, queries):
+        return kneighbors(
+            queries, self.reference, self.n_neighbors, metric=self.metric, dtype=self.dtype,
+            reference_norms=self.reference_norms(), block_bytes=self.block_bytes
+        )
+
+    def kneighbors(self, X):
+        queries = np.ascontiguousarray(X, dtype=self.dtype)
+        n_jobs = default_n_jobs() if self.n_jobs in (None, -1) else self.n_jobs
+        if n_jobs <= 1 or queries.shape[0] < 2 * n_jobs:
+            return self._kneighbors(queries)
+
+        self.reference_norms()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=n_jobs)
+        shards = np.array_split(queries, n_jobs)
+        results = list(self._executor.map(self._kneighbors, shards))
+        return np.concatenate([r[0] for r in results]), np.concatenate([r[1] for r in results])
+
+    def predict_proba(self, X):
+        distances, indices = self.kneighbors(X)
+        return vote(self.labels[indices], distances, len(self.classes_), self.weights)
+
+    def predict(self, X):
+        return self.classes_[np.argmax(self.predict_proba(X), axis=1)]
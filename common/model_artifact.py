@@ -0,0 +1,165 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+import knn
+
+# Versioned, memory mappable artifact for the KNN model. A directory holding
+#
+#   manifest.json   format version, hyperparameters, class names, dtype, checksums
+#   features.npy    reference feature matrix, C contiguous, manifest dtype
+#   labels.npy      int32 index into the manifest class names for every reference row
+#   index.pkl       optional prebuilt sklearn KDTree / BallTree over features.npy
+#
+# Loading memory maps the .npy files, so the reference set is shared with the page
+# cache instead of being copied into the process, and scoring goes through the
+# NumPy engine in knn.py so scikit-learn is only needed for the optional index.
+
+FORMAT_NAME = "knn-artifact"
+FORMAT_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+FEATURES_FILE = "features.npy"
+LABELS_FILE = "labels.npy"
+INDEX_FILE = "index.pkl"
+SUPPORTED_METRICS = ["euclidean", "manhattan", "minkowski"]
+
+
+def sha256_file(path, block_bytes=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as stream:
+        for block in iter(lambda: stream.read(block_bytes), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _metric_name(metric, p):
+    # sklearn's default is minkowski with p=2, store the concrete metric instead
+    if metric == "minkowski":
+        if p == 1:
+            return "manhattan"
+        if p == 2:
+            return "euclidean"
+    if metric not in SUPPORTED_METRICS or metric == "minkowski":
+        raise ValueError("unsupported metric for the artifact format: "+str(metric)+" p="+str(p))
+    return metric
+
+
+def write_artifact(directory, features, labels, n_neighbors, feature_columns,
+        weights="uniform", metric="minkowski", p=2, dtype="float32", index_type=None, extra=None):
+    """Write features / labels and the KNN hyperparameters as an artifact directory.
+
+    index_type may be "kd_tree" or "ball_tree" to also store a prebuilt sklearn
+    neighbour index. Returns the manifest.
+    """
+    os.makedirs(directory, exist_ok=True)
+    metric = _metric_name(metric, p)
+    features = np.ascontiguousarray(features, dtype=dtype)
+    classes, encoded = np.unique(np.asarray(labels), return_inverse=True)
+
+    np.save(os.path.join(directory, FEATURES_FILE), features)
+    np.save(os.path.join(directory, LABELS_FILE), encoded.astype(np.int32))
+    files = [FEATURES_FILE, LABELS_FILE]
+
+    if index_type is not None:
+        import pickle
+        from sklearn.neighbors import BallTree, KDTree
+        tree_class = {"kd_tree": KDTree, "ball_tree": BallTree}[index_type]
+        with open(os.path.join(directory, INDEX_FILE), "wb") as stream:
+            pickle.dump(tree_class(features, metric=metric), stream)
+        files.append(INDEX_FILE)
+
+    manifest = {
+        "format": FORMAT_NAME,
+        "format_version": FORMAT_VERSION,
+        "n_neighbors": int(n_neighbors),
+        "weights": weights,
+        "metric": metric,
+        "feature_columns": list(feature_columns),
+        "classes": classes.tolist(),
+        "dtype": np.dtype(dtype).name,
+        "n_samples": int(features.shape[0]),
+        "n_features": int(features.shape[1]),
+        "index": index_type,
+        "files": {name: sha256_file(os.path.join(directory, name)) for name in files}
+    }
+    if extra:
+        manifest.update(extra)
+    with open(os.path.join(directory, MANIFEST_FILE), "w") as stream:
+        json.dump(manifest, stream, indent=2)
+    return manifest
+
+
+def export_knn(model, directory, feature_columns, features, labels, dtype="float32", index_type=None, extra=None):
+    """Export a fitted KNeighborsClassifier, given the data it was fitted on."""
+    params = model.get_params()
+    return write_artifact(
+        directory, features, labels, params["n_neighbors"], feature_columns,
+        weights=params["weights"], metric=params["metric"], p=params["p"],
+        dtype=dtype, index_type=index_type, extra=extra
+    )
+
+
+def read_manifest(directory):
+    with open(os.path.join(directory, MANIFEST_FILE)) as stream:
+        manifest = json.load(stream)
+    if manifest.get("format") != FORMAT_NAME or manifest.get("format_version", 0) > FORMAT_VERSION:
+        raise ValueError("unsupported model artifact "+str(manifest.get("format"))+" v"+str(manifest.get("format_version")))
+    return manifest
+
+
+def verify_artifact(directory, manifest=None):
+    manifest = manifest or read_manifest(directory)
+    for name, checksum in manifest["files"].items():
+        if sha256_file(os.path.join(directory, name)) != checksum:
+            raise ValueError("checksum mismatch for "+os.path.join(directory, name))
+
+
+def load_artifact(directory, mmap=True, verify=False, use_index=False, n_jobs=1, dtype="float64"):
+    manifest = read_manifest(directory)
+    if verify:
+        verify_artifact(directory, manifest)
+    mmap_mode = "r" if mmap else None
+    features = np.load(os.path.join(directory, FEATURES_FILE), mmap_mode=mmap_mode)
+    labels = np.load(os.path.join(directory, LABELS_FILE), mmap_mode=mmap_mode)
+    index = None
+    if use_index and manifest.get("index"):
+        import pickle
+        with open(os.path.join(directory, INDEX_FILE), "rb") as stream:
+            index = pickle.load(stream)
+    return KnnArtifact(manifest, features, labels, index, n_jobs=n_jobs, dtype=dtype)
+
+
+class KnnArtifact(knn.KnnPredictor):
+    """Predictor over a loaded artifact, scoring with the vectorized KNN engine.
+
+    dtype is the precision distances are computed in, independent of the storage
+    dtype in the manifest. float32 halves the memory traffic at the cost of exact
+    parity with sklearn on near ties.
+    """
+
+    def __init__(self, manifest, features, labels, index=None, n_jobs=1, dtype="float64"):
+        super().__init__(
+            features, labels, manifest["classes"],
+            n_neighbors=manifest["n_neighbors"],
+            weights=manifest["weights"],
+            metric=manifest["metric"],
+            dtype=dtype,
+            n_jobs=n_jobs
+        )
+        self.manifest = manifest
+        self.features = features
+        self.index = index
+
+    @property
+    def nbytes(self):
+        # memory mapped arrays live in the page cache, not in the process
+        if isinstance(self.features, np.memmap):
+            return 0
+        return self.features.nbytes + self.labels.nbytes
+
+    def kneighbors(self, X):
+        if self.index is not None:
+            return self.index.query(np.asarray(X, dtype=self.dtype), k=self.n_neighbors)
+        return super().kneighbors(X)
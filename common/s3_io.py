@@ -0,0 +1,105 @@
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+# Shared S3 I/O. One client per process with a connection pool large enough for
+# the transfer threads, so warm invocations reuse open connections instead of
+# creating a client (and its TLS handshakes) per invocation. Objects are read
+# into memory with parallel ranged GETs and written with parallel multipart
+# uploads once they pass the multipart threshold, and copies between keys are
+# done server side. The pool and transfer sizes can be tuned per function with
+# S3_MAX_POOL_CONNECTIONS, S3_MULTIPART_THRESHOLD, S3_MULTIPART_CHUNKSIZE and
+# S3_MAX_CONCURRENCY.
+
+MiB = 1024 * 1024
+
+_clients = {}
+
+
+def max_pool_connections():
+    return int(os.environ.get("S3_MAX_POOL_CONNECTIONS", "32"))
+
+
+def client_config():
+    return Config(
+        max_pool_connections=max_pool_connections(),
+        retries={"max_attempts": 5, "mode": "adaptive"},
+        tcp_keepalive=True
+    )
+
+
+def client():
+    """The process wide S3 client, created on first use."""
+    if "client" not in _clients:
+        _clients["client"] = boto3.client("s3", config=client_config())
+    return _clients["client"]
+
+
+def resource():
+    """The process wide S3 resource, its meta.client has the same configuration as client()."""
+    if "resource" not in _clients:
+        _clients["resource"] = boto3.resource("s3", config=client_config())
+    return _clients["resource"]
+
+
+def transfer_config(max_concurrency=None):
+    # the transfer threads never need more connections than the pool holds
+    return TransferConfig(
+        multipart_threshold=int(os.environ.get("S3_MULTIPART_THRESHOLD", 16 * MiB)),
+        multipart_chunksize=int(os.environ.get("S3_MULTIPART_CHUNKSIZE", 16 * MiB)),
+        max_concurrency=min(max_concurrency or int(os.environ.get("S3_MAX_CONCURRENCY", "16")), max_pool_connections()),
+        use_threads=True
+    )
+
+
+def read_bytes(s3, bucket, key, config=None):
+    """The body of s3://bucket/key, fetched with parallel ranged GETs when it is large."""
+    buffer = io.BytesIO()
+    s3.download_fileobj(bucket, key, buffer, Config=config or transfer_config())
+    return buffer.getvalue()
+
+
+def read_many(s3, bucket, keys, max_workers=None):
+    """The bodies of keys, in order, read concurrently."""
+    if len(keys) <= 1:
+        return [read_bytes(s3, bucket, key) for key in keys]
+    pool = max_pool_connections()
+    workers = min(max_workers or len(keys), pool)
+    # every worker gets its share of the pool for ranged GETs, together they
+    # never hold more connections than the pool keeps open
+    config = transfer_config(max_concurrency=max(1, pool // workers))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(lambda key: read_bytes(s3, bucket, key, config), keys))
+
+
+def write_bytes(s3, bucket, key, body):
+    """Upload body from memory, as a parallel multipart upload when it is large."""
+    s3.upload_fileobj(io.BytesIO(body), bucket, key, Config=transfer_config())
+
+
+def download_file(s3, bucket, key, path):
+    s3.download_file(bucket, key, path, Config=transfer_config())
+
+
+def upload_file(s3, path, bucket, key):
+    s3.upload_file(path, bucket, key, Config=transfer_config())
+
+
+def copy(s3, bucket, source_key, key, source_bucket=None):
+    """Copy an object server side, a single CopyObject below the multipart threshold."""
+    s3.copy({"Bucket": source_bucket or bucket, "Key": source_key}, bucket, key, Config=transfer_config())
+
+
+def exists(s3, bucket, key):
+    try:
+        s3.head_object(Bucket=bucket, Key=key)
+        return True
+    except ClientError as error:
+        if error.response["Error"]["Code"] not in ["NoSuchKey", "404"]:
+            raise
+        return False
@@ -0,0 +1,97 @@
+import json
+import warnings
+
+import numpy as np
+
+# Parses request records straight into a contiguous float32 feature matrix, one
+# row per record and one column per feature, so that a whole batch is scored with
+# a single predict / predict_proba call.
+
+
+def _fill_row(matrix, ids, row, record, feature_columns):
+    if isinstance(record, dict):
+        ids.append(record.get("id"))
+        features = record["features"] if "features" in record else [record[column] for column in feature_columns]
+    else:
+        ids.append(None)
+        features = record
+    if len(features) != len(feature_columns):
+        raise ValueError("record " + str(row) + " has " + str(len(features)) + " features, expected " + str(len(feature_columns)))
+    matrix[row] = features
+
+
+def parse_records(records, feature_columns):
+    """Parse a list of records into (ids, float32 matrix).
+
+    A record is either a list of feature values in feature_columns order, or an
+    object keyed by the feature column names (or holding them as "features") with
+    an optional "id" that is echoed back with its prediction.
+    """
+    matrix = np.empty((len(records), len(feature_columns)), dtype=np.float32)
+    ids = []
+    for row, record in enumerate(records):
+        _fill_row(matrix, ids, row, record, feature_columns)
+    return ids, matrix
+
+
+def parse_jsonl(body, feature_columns):
+    """Parse JSON lines bytes into (ids, float32 matrix), skipping blank lines."""
+    lines = [line for line in body.splitlines() if line.strip()]
+    matrix = np.empty((len(lines), len(feature_columns)), dtype=np.float32)
+    ids = []
+    for row, line in enumerate(lines):
+        _fill_row(matrix, ids, row, json.loads(line), feature_columns)
+    return ids, matrix
+
+
+def parse_csv(body, feature_columns, label_column=None, dtype=np.float64):
+    """Parse CSV bytes with a header row into (matrix, labels or None) without pandas."""
+    lines = body.decode().splitlines()
+    columns = lines[0].split(",")
+    text = [line for line in lines[1:] if line.strip()]
+    feature_idx = [columns.index(column) for column in feature_columns]
+    matrix = np.loadtxt(text, delimiter=",", usecols=feature_idx, dtype=dtype, ndmin=2)
+    labels = None
+    if label_column is not None:
+        labels = np.loadtxt(text, delimiter=",", usecols=[columns.index(label_column)], dtype=str, ndmin=1)
+    return matrix, labels
+
+
+def predict_proba_batch(model, matrix):
+    """Score the whole matrix with a single predict_proba, returning (predictions, probabilities).
+
+    The prediction is the most probable class, the first one on ties like the
+    estimators' own predict.
+    """
+    with warnings.catch_warnings():
+        # estimators fitted on a DataFrame warn about the missing column names
+        warnings.filterwarnings("ignore", message="X does not have valid feature names")
+        proba = model.predict_proba(matrix)
+    return np.asarray(model.classes_)[np.argmax(proba, axis=1)], proba
+
+
+def predict_batch(model, matrix, probabilities=False):
+    """Score the whole matrix at once, returning (predictions, probabilities or None)."""
+    if probabilities:
+        # the predictions are read off the probabilities, one neighbour search per batch
+        return predict_proba_batch(model, matrix)
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", message="X does not have valid feature names")
+        prediction = model.predict(matrix)
+    return prediction, None
+
+
+def format_results(ids, prediction, proba=None, classes=None):
+    results = []
+    for row, label in enumerate(prediction):
+        result = {"prediction": label.item() if hasattr(label, "item") else label}
+        if ids[row] is not None:
+            result["id"] = ids[row]
+        if proba is not None:
+            result["probabilities"] = dict(zip([str(c) for c in classes], proba[row].tolist()))
+        results.append(result)
+    return results
+
+
+def to_jsonl(results):
+    return "".join(json.dumps(result) + "\n" for result in results).encode()
@@ -1,43 +1,216 @@
+import json
 import os
-import numpy as np
-import pandas as pd
-import boto3
-import sklearn
-from sklearn.model_selection import train_test_split
-from sklearn.neighbors import KNeighborsClassifier
-from sklearn import metrics
 import pickle
 import datetime
 
-def handler(event, context):
+import startup
+
+# Cold starts pay for every import, so the entry point only imports what every
+# path needs and goes through the profiler to report what each import cost. The
+# streaming code and the model artifact reader are imported on first use, pandas
+# is not used at all and scikit-learn only gets imported by unpickling a model.
+profiler = startup.StartupProfiler()
+np = profiler.import_module("numpy")
+batch = profiler.import_module("batch")
+# used by warm_cache, imported first so its cost shows up on its own
+profiler.import_module("boto3")
+warm_cache = profiler.import_module("warm_cache")
+instrumentation = profiler.import_module("instrumentation")
+s3_io = profiler.import_module("s3_io")
+
+DATA_AND_MODEL_BUCKET = "cdk-ml-pipeline-iris"
+DATA_KEY = "data/Iris.csv"
+MODEL_PATH = "finalized_model.sav"
+MODEL_ARTIFACT_DIR = "model_artifact"
+# copied next to the artifact by the image build, names the model version
+MODEL_VERSION_FILE = "version.json"
+FEATURE_COLUMNS = ['SepalLengthCm','SepalWidthCm','PetalLengthCm','PetalWidthCm']
+
+# Lives for the lifetime of the container, warm invocations reuse the boto3
+# resource, the unpickled estimator and the parsed data set
+cache = warm_cache.WarmCache.from_environment()
+metrics = instrumentation.Metrics.from_environment()
+# version.json is baked into the image, it is read once per path rather than
+# through the cache so that naming the version does not count as a cache hit
+_model_versions = {}
+
+
+def load_model():
+    with profiler.phase("load_model"), metrics.timer("LoadModelTime"):
+        return _load_model()
+
+
+def _load_model():
+    # MODEL_KEY lets the function pick up models/latest/ from S3 instead of the
+    # model baked into the image
+    model_key = os.environ.get("MODEL_KEY")
+    if model_key:
+        return cache.get_s3_object(DATA_AND_MODEL_BUCKET, model_key, pickle.loads)
+    # Prefer the memory mapped artifact, images built before it existed only have the pickle
+    model_artifact = profiler.import_module("model_artifact")
+    artifact_dir = os.environ.get("MODEL_ARTIFACT_DIR", MODEL_ARTIFACT_DIR)
+    manifest_path = os.path.join(artifact_dir, model_artifact.MANIFEST_FILE)
+    if os.path.exists(manifest_path):
+        return cache.get_file(
+            manifest_path,
+            lambda path: model_artifact.load_artifact(
+                artifact_dir,
+                verify=os.environ.get("MODEL_ARTIFACT_VERIFY") == "1",
+                use_index=os.environ.get("MODEL_ARTIFACT_USE_INDEX") == "1",
+                n_jobs=int(os.environ.get("KNN_N_JOBS", "-1")),
+                dtype=os.environ.get("KNN_DTYPE", "float64")
+            )
+        )
+    return cache.get_file(MODEL_PATH, lambda path: pickle.load(open(path, "rb")))
 
-    s3 = boto3.resource('s3')
-    data_and_model_bucket="cdk-ml-pipeline-iris"
-    key="data/Iris.csv"
-    s3.Bucket(data_and_model_bucket).download_file(key, "/tmp/Iris.csv")
 
-    iris = pd.read_csv("/tmp/Iris.csv")
+def model_version():
+    # models/<hash>/finalized_model.sav names its version, a model baked into the
+    # image is named by the version.json the image build copied next to it
+    model_key = os.environ.get("MODEL_KEY")
+    if model_key:
+        return model_key.rsplit("/", 2)[-2] if "/" in model_key else model_key
+    path = os.path.join(os.environ.get("MODEL_ARTIFACT_DIR", MODEL_ARTIFACT_DIR), MODEL_VERSION_FILE)
+    if path not in _model_versions:
+        if not os.path.exists(path):
+            return "unknown"
+        with open(path) as version_file:
+            _model_versions[path] = json.load(version_file)["model_hash"]
+    return _model_versions[path]
 
-    train, test = train_test_split(iris, test_size = 0.3)
-    # in this our main data is split into train and test
-    # the attribute test_size=0.3 splits the data into 70% and 30% ratio. train=70% and test=30%
 
-    train_X = train[['SepalLengthCm','SepalWidthCm','PetalLengthCm','PetalWidthCm']]# taking the training data features
-    train_y=train.Species# output of our training data
-    test_X= test[['SepalLengthCm','SepalWidthCm','PetalLengthCm','PetalWidthCm']] # taking test data features
-    test_y =test.Species   #output value of test data
+def parse_dataset(body):
+    # (features, species) NumPy arrays, the CSV is parsed without pandas
+    metrics.count("BytesDownloaded", len(body), instrumentation.BYTES)
+    with metrics.timer("CsvParseTime"):
+        return batch.parse_csv(body, FEATURE_COLUMNS, label_column="Species")
 
-    # load pre trained model
-    # model_key="models/latest/finalized_model.sav"
-    # s3.Bucket(data_and_model_bucket).download_file(model_key, "/tmp/finalized_model.sav")
 
-    model=pickle.load(open("finalized_model.sav", "rb"))
-    prediction=model.predict(test_X)
-    print('The accuracy of the KNN is',metrics.accuracy_score(prediction,test_y))
+def load_dataset():
+    # the S3 download and the parse on a cache miss, a revalidation or nothing on a hit
+    with profiler.phase("load_dataset"), metrics.timer("LoadDatasetTime"):
+        return cache.get_s3_object(DATA_AND_MODEL_BUCKET, DATA_KEY, parse_dataset)
 
-    prediction_csv = pd.DataFrame(prediction, columns=['prediction']).to_csv('/tmp/prediction.csv')
 
+def timestamped_path(filename):
     t = datetime.datetime.now()
-    path="inference-results/"+t.strftime('%m-%d-%Y %H-%M-%S')+"/prediction.csv"
+    return "inference-results/"+t.strftime('%m-%d-%Y %H-%M-%S')+"/"+filename
+
+
+def batch_handler(event, s3):
+    # Records come either inline or as a JSON lines object in S3
+    if "records_s3" in event:
+        source = event["records_s3"]
+        with metrics.timer("S3DownloadTime"):
+            body = s3_io.read_bytes(s3.meta.client, source["bucket"], source["key"])
+        metrics.count("BytesDownloaded", len(body), instrumentation.BYTES)
+        with metrics.timer("ParseTime"):
+            ids, matrix = batch.parse_jsonl(body, FEATURE_COLUMNS)
+    else:
+        with metrics.timer("ParseTime"):
+            ids, matrix = batch.parse_records(event["records"], FEATURE_COLUMNS)
+
+    model = load_model()
+    probabilities = event.get("probabilities", False)
+    with metrics.timer("PredictTime"):
+        prediction, proba = batch.predict_batch(model, matrix, probabilities)
+    profiler.first_prediction()
+    with metrics.timer("SerializeTime"):
+        results = batch.format_results(ids, prediction, proba, model.classes_)
+    metrics.count("RowsProcessed", len(results))
+
+    if event.get("output", "response") == "s3":
+        bucket = os.environ['INFERENCE_RESULTS_BUCKET']
+        path = timestamped_path("predictions.jsonl")
+        with metrics.timer("SerializeTime"):
+            body = batch.to_jsonl(results)
+        with metrics.timer("S3UploadTime"):
+            s3_io.write_bytes(s3.meta.client, bucket, path, body)
+        metrics.count("BytesUploaded", len(body), instrumentation.BYTES)
+        return {"count": len(results), "results_s3": {"bucket": bucket, "key": path}}
+
+    return {"count": len(results), "results": results}
+
+
+def stream_handler(event, s3):
+    # Streams s3://bucket/key (optionally only the byte range [start, end)) through
+    # the model in fixed size blocks, peak memory is bounded by the block sizes
+    streaming = profiler.import_module("streaming")
+    source = event["stream"]
+    key = source["key"]
+    input_format = source.get("format", "jsonl" if key.endswith(".jsonl") else "csv")
+    output_key = source.get("output_key") or timestamped_path("prediction." + input_format)
+
+    response = streaming.score_stream(
+        s3.meta.client, load_model(), source["bucket"], key,
+        source.get("output_bucket", os.environ['INFERENCE_RESULTS_BUCKET']), output_key,
+        FEATURE_COLUMNS,
+        input_format=input_format,
+        start=source.get("start", 0),
+        end=source.get("end"),
+        probabilities=event.get("probabilities", False),
+        block_rows=int(os.environ.get("STREAM_BLOCK_ROWS", streaming.DEFAULT_BLOCK_ROWS)),
+        chunk_bytes=int(os.environ.get("STREAM_CHUNK_BYTES", streaming.DEFAULT_CHUNK_BYTES)),
+        part_bytes=int(os.environ.get("STREAM_PART_BYTES", streaming.DEFAULT_PART_BYTES)),
+        metrics=metrics
+    )
+    profiler.first_prediction()
+    metrics.set_property("output_s3", response["output_s3"])
+    return response
+
+
+def prediction_csv(prediction):
+    # same layout as the DataFrame.to_csv output this used to be, index column included
+    return (",prediction\n" + "".join(str(row) + "," + str(label) + "\n" for row, label in enumerate(prediction))).encode()
+
+
+def handler(event, context):
+    metrics.begin()
+    try:
+        metrics.set_dimension("ModelVersion", model_version())
+        return _handle(event, cache.resource('s3'))
+    finally:
+        startup_report = profiler.take_report()
+        if startup_report is not None:
+            metrics.set_property("startup", startup_report)
+            metrics.put("InitTime", startup_report["init_seconds"] * 1000, instrumentation.MILLISECONDS)
+            metrics.put("TimeToFirstPrediction", startup_report["first_prediction_seconds"] * 1000, instrumentation.MILLISECONDS)
+        metrics.set_property("cache", cache.stats())
+        metrics.flush()
+
+
+def _handle(event, s3):
+
+    if event and "stream" in event:
+        return stream_handler(event, s3)
+
+    if event and ("records" in event or "records_s3" in event):
+        return batch_handler(event, s3)
+
+    features, species = load_dataset()
+
+    # score a random 30% of the data set, equivalent to the test side of a
+    # train_test_split(test_size=0.3) without copying the whole data set
+    test_size = int(np.ceil(len(species) * 0.3))
+    test = np.random.permutation(len(species))[:test_size]
+
+    test_X= features[test] # taking test data features
+    test_y =species[test]   #output value of test data
+
+    model=load_model()
+    with metrics.timer("PredictTime"):
+        prediction, _ = batch.predict_batch(model, test_X)
+    profiler.first_prediction()
+    metrics.count("RowsProcessed", len(prediction))
+    metrics.put("Accuracy", float(np.mean(prediction == test_y)), "None")
+
+    path=timestamped_path("prediction.csv")
+
+    with metrics.timer("SerializeTime"):
+        body = prediction_csv(prediction)
+    with metrics.timer("S3UploadTime"):
+        s3_io.write_bytes(s3.meta.client, os.environ['INFERENCE_RESULTS_BUCKET'], path, body)
+    metrics.count("BytesUploaded", len(body), instrumentation.BYTES)
+
 
-    s3.Bucket(os.environ['INFERENCE_RESULTS_BUCKET']).upload_file('/tmp/prediction.csv', path)
+profiler.end_init()
@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+"""Online single row predictions with micro-batching.
+
+    python serving.py --port 8080
+    curl -X POST localhost:8080/predict -d '{"features": [5.1, 3.5, 1.4, 0.2]}'
+
+Requests are parsed like the batch path's records (a list of feature values, an
+object keyed by the feature columns or holding them as "features", with an
+optional "id"), a body of {"records": [...]} submits several rows at once.
+Concurrent requests are put on a bounded queue and a single worker coalesces
+them into micro-batches of at most max_batch_size rows, waiting at most
+max_wait_ms for a batch to fill, which are scored with one predict_proba call
+off the event loop. A full queue rejects new requests with a 503 instead of
+letting latency grow without bound. Recent feature vectors and their results are
+kept in a small LRU cache, which the worker consults once it has checked the
+model for the batch, so a cached result never outlives its model and only the
+rows that miss reach predict_proba. Request latencies go into a histogram
+reported by GET /stats with the batch and cache counters.
+
+The model comes from inference.load_model, so the online path picks up the same
+artifact, pickle or MODEL_KEY object as the batch handler and keeps it warm in
+the same cache. url_handler serves the same routes behind a Lambda function URL.
+A Lambda container handles one invocation at a time, so there the coalescing
+only spans the rows of one request and max_wait_ms defaults to 0.
+"""
+import argparse
+import asyncio
+import base64
+import bisect
+import json
+import math
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import batch
+import inference
+
+DEFAULT_MAX_BATCH_SIZE = 64
+DEFAULT_MAX_WAIT_MS = 2.0
+DEFAULT_MAX_QUEUE = 1024
+DEFAULT_CACHE_SIZE = 4096
+
+STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 503: "Service Unavailable"}
+
+
+class Overloaded(Exception):
+    """The request queue is full, the client should back off and retry."""
+
+
+class LatencyHistogram:
+    """Latencies in geometrically growing buckets, percentiles are accurate to one bucket (5%)."""
+
+    def __init__(self, min_ms=0.01, max_ms=60000.0, growth=1.05):
+        self.bounds = []
+        bound = min_ms
+        while bound < max_ms:
+            self.bounds.append(bound)
+            bound *= growth
+        self.bounds.append(max_ms)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def record(self, ms):
+        self.counts[bisect.bisect_left(self.bounds, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def percentile(self, percent):
+        """Upper bound of the bucket holding the percentile, None before the first record."""
+        if not self.count:
+            return None
+        rank = max(1, math.ceil(percent / 100 * self.count))
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                bound = self.bounds[bucket] if bucket < len(self.bounds) else self.max_ms
+                return min(bound, self.max_ms)
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean_ms": self.total_ms / self.count if self.count else None,
+            "p50_ms": self.percentile(50),
+            "p95_ms": self.percentile(95),
+            "p99_ms": self.percentile(99),
+            "max_ms": self.max_ms
+        }
+
+
+class PredictionCache:
+    """LRU cache of feature vector bytes to the formatted result of that row."""
+
+    def __init__(self, max_entries=DEFAULT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        result = self._entries.get(key)
+        if result is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return result
+
+    def put(self, key, result):
+        if self.max_entries <= 0:
+            return
+        self._entries[key] = result
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "entries": len(self._entries)}
+
+
+class MicroBatcher:
+    """Coalesces concurrent single row predictions into vectorized predict_proba calls."""
+
+    def __init__(self, load_model=None, feature_columns=inference.FEATURE_COLUMNS,
+            max_batch_size=DEFAULT_MAX_BATCH_SIZE, max_wait_ms=DEFAULT_MAX_WAIT_MS,
+            max_queue=DEFAULT_MAX_QUEUE, cache_size=DEFAULT_CACHE_SIZE):
+        self.load_model = load_model or inference.load_model
+        self.feature_columns = feature_columns
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.max_queue = max_queue
+        self.cache = PredictionCache(cache_size)
+        self.latency = LatencyHistogram()
+        self.requests = 0
+        self.batches = 0
+        self.batched_rows = 0
+        self.rejected = 0
+        self.queue = None
+        self._worker = None
+        self._model = None
+        # scoring runs on one thread off the event loop, the model may fan out itself
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    @classmethod
+    def from_environment(cls, max_wait_ms=DEFAULT_MAX_WAIT_MS, **kwargs):
+        return cls(
+            max_batch_size=int(os.environ.get("SERVING_MAX_BATCH_SIZE", DEFAULT_MAX_BATCH_SIZE)),
+            max_wait_ms=float(os.environ.get("SERVING_MAX_WAIT_MS", max_wait_ms)),
+            max_queue=int(os.environ.get("SERVING_MAX_QUEUE", DEFAULT_MAX_QUEUE)),
+            cache_size=int(os.environ.get("SERVING_CACHE_SIZE", DEFAULT_CACHE_SIZE)),
+            **kwargs
+        )
+
+    async def start(self):
+        self.queue = asyncio.Queue(maxsize=self.max_queue)
+        self._worker = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+
+    async def predict(self, record):
+        """The result of one record, scored in whatever micro-batch it lands in."""
+        start = time.perf_counter()
+        self.requests += 1
+        ids, matrix = batch.parse_records([record], self.feature_columns)
+        row = matrix[0]
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((row, row.tobytes(), future))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise Overloaded("prediction queue is full ("+str(self.max_queue)+" requests)")
+        result = await future
+        if ids[0] is not None:
+            result = dict(result, id=ids[0])
+        self.latency.record((time.perf_counter() - start) * 1000)
+        return result
+
+    async def _next_batch(self):
+        items = [await self.queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait_ms / 1000
+        while len(items) < self.max_batch_size:
+            try:
+                items.append(self.queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                items.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return items
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            items = await self._next_batch()
+            try:
+                results = await loop.run_in_executor(self._executor, self._score, [(row, key) for row, key, _ in items])
+            except Exception as error:
+                for _, _, future in items:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+            for (_, _, future), result in zip(items, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def _score(self, items):
+        # Runs on the worker thread, the only one that touches the model or the
+        # cache. The model is looked up through the warm cache once per batch, so a
+        # new model is picked up like on the batch path, and cached results of the
+        # previous one are dropped before any is answered from the cache.
+        model = self.load_model()
+        if model is not self._model:
+            self.cache.clear()
+            self._model = model
+        results = [self.cache.get(key) for _, key in items]
+        misses = [index for index, result in enumerate(results) if result is None]
+        if not misses:
+            return results
+        prediction, proba = batch.predict_proba_batch(model, np.stack([items[index][0] for index in misses]))
+        scored = batch.format_results([None] * len(misses), prediction, proba, model.classes_)
+        for index, result in zip(misses, scored):
+            self.cache.put(items[index][1], result)
+            results[index] = result
+        self.batches += 1
+        self.batched_rows += len(misses)
+        return results
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "batches": self.batches,
+            "mean_batch_size": self.batched_rows / self.batches if self.batches else None,
+            "rejected": self.rejected,
+            "queue_depth": self.queue.qsize() if self.queue is not None else 0,
+            "cache": self.cache.stats(),
+            "latency": self.latency.summary()
+        }
+
+
+async def dispatch(batcher, method, path, body):
+    """(status, payload) of one request, shared by the HTTP server and the function URL handler."""
+    if method == "GET" and path == "/health":
+        return 200, {"status": "ok"}
+    if method == "GET" and path == "/stats":
+        return 200, batcher.stats()
+    if method != "POST" or path not in ["/", "/predict"]:
+        return 404, {"error": "no route for "+method+" "+path}
+
+    try:
+        request = json.loads(body or b"null")
+        if isinstance(request, dict) and "records" in request:
+            results = await asyncio.gather(*[batcher.predict(record) for record in request["records"]])
+            return 200, {"count": len(results), "results": list(results)}
+        return 200, await batcher.predict(request)
+    except Overloaded as error:
+        return 503, {"error": str(error)}
+    except (ValueError, KeyError, TypeError) as error:
+        return 400, {"error": "invalid request: "+str(error)}
+
+
+async def handle_connection(batcher, reader, writer):
+    # Minimal HTTP/1.1: one JSON request per message, keep-alive unless the client closes
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line.strip():
+                break
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in [b"\r\n", b"\n", b""]:
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            parts = request_line.decode("latin-1").split()
+            body = await reader.readexactly(int(headers.get("content-length", "0")))
+            if len(parts) != 3:
+                status, payload = 400, {"error": "malformed request line"}
+            else:
+                status, payload = await dispatch(batcher, parts[0], parts[1].split("?")[0], body)
+            keep_alive = headers.get("connection", "").lower() != "close" and status != 400
+            data = json.dumps(payload).encode()
+            writer.write((
+                "HTTP/1.1 " + str(status) + " " + STATUS_TEXT.get(status, "") + "\r\n"
+                "Content-Type: application/json\r\n"
+                "Content-Length: " + str(len(data)) + "\r\n"
+                "Connection: " + ("keep-alive" if keep_alive else "close") + "\r\n\r\n"
+            ).encode() + data)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_server(batcher, host="127.0.0.1", port=8080):
+    await batcher.start()
+    return await asyncio.start_server(lambda reader, writer: handle_connection(batcher, reader, writer), host, port)
+
+
+# Lambda function URL adapter. The event loop and the batcher live for the
+# lifetime of the container, every invocation runs the loop for one request.
+_loop = None
+_batcher = None
+
+
+def url_handler(event, context):
+    global _loop, _batcher
+    if _batcher is None:
+        _loop = asyncio.new_event_loop()
+        _batcher = MicroBatcher.from_environment(max_wait_ms=0)
+        _loop.run_until_complete(_batcher.start())
+
+    metrics = inference.metrics
+    metrics.begin()
+    try:
+        http = event.get("requestContext", {}).get("http", {})
+        body = event.get("body") or ""
+        body = base64.b64decode(body) if event.get("isBase64Encoded") else body.encode()
+        with metrics.timer("RequestTime"):
+            status, payload = _loop.run_until_complete(
+                dispatch(_batcher, http.get("method", "POST"), event.get("rawPath", "/"), body)
+            )
+        metrics.set_dimension("ModelVersion", inference.model_version())
+        metrics.count("Rejected", 1 if status == 503 else 0)
+        return {"statusCode": status, "headers": {"Content-Type": "application/json"}, "body": json.dumps(payload)}
+    finally:
+        metrics.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--max-batch-size", type=int, default=DEFAULT_MAX_BATCH_SIZE)
+    parser.add_argument("--max-wait-ms", type=float, default=DEFAULT_MAX_WAIT_MS)
+    parser.add_argument("--max-queue", type=int, default=DEFAULT_MAX_QUEUE)
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_CACHE_SIZE)
+    args = parser.parse_args()
+
+    async def serve():
+        batcher = MicroBatcher(max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms,
+            max_queue=args.max_queue, cache_size=args.cache_size)
+        server = await start_server(batcher, args.host, args.port)
+        print("Serving predictions on http://"+args.host+":"+str(args.port))
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(serve())
+
+
+if __name__ == "__main__":
+    main()
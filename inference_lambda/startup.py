@@ -0,0 +1,97 @@
+import importlib
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+# Cold start profiler. The inference entry point imports its dependencies through
+# StartupProfiler.import_module and wraps its first model load and prediction in
+# phases, so that the first invocation of a container can report how long every
+# import took, how long the init phase ran and how long it took from the process
+# start to the first prediction. For a breakdown of every nested import run the
+# function with PYTHONPROFILEIMPORTTIME=1, the interpreter then logs it to stderr.
+
+
+def process_age_seconds():
+    """Seconds since this process was started, None where /proc is not available."""
+    try:
+        with open("/proc/self/stat") as stat:
+            # the command name may contain spaces, the fields after it do not
+            start_ticks = int(stat.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as uptime:
+            uptime_seconds = float(uptime.read().split()[0])
+        return uptime_seconds - start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class StartupProfiler:
+    """Records import and phase durations until the first prediction is reported."""
+
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.start = clock()
+        self.process_age_at_start = process_age_seconds()
+        self.imports = {}
+        self.phases = {}
+        self.init_seconds = None
+        self.first_prediction_seconds = None
+        self.reported = False
+
+    def import_module(self, name):
+        """Import name, recording how long it took if this is its first import."""
+        if name in sys.modules:
+            return sys.modules[name]
+        start = self.clock()
+        modules_before = len(sys.modules)
+        module = importlib.import_module(name)
+        self.imports[name] = {
+            "seconds": self.clock() - start,
+            # nested imports included, a large count points at a heavy dependency
+            "modules_loaded": len(sys.modules) - modules_before
+        }
+        return module
+
+    def end_init(self):
+        if self.init_seconds is None:
+            self.init_seconds = self.clock() - self.start
+
+    @contextmanager
+    def phase(self, name):
+        """Time the first run of a phase, later runs of the same phase are not recorded."""
+        if self.reported or name in self.phases:
+            yield
+            return
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.clock() - start
+
+    def first_prediction(self):
+        """Mark the first prediction, returning True the first time only."""
+        if self.first_prediction_seconds is not None:
+            return False
+        self.first_prediction_seconds = self.clock() - self.start
+        return True
+
+    def report(self):
+        report = {
+            "imports": self.imports,
+            "import_seconds": sum(entry["seconds"] for entry in self.imports.values()),
+            "init_seconds": self.init_seconds,
+            "phases": self.phases,
+            "first_prediction_seconds": self.first_prediction_seconds,
+            "modules": len(sys.modules)
+        }
+        # include the interpreter and runtime bootstrap that ran before this module
+        if self.process_age_at_start is not None and self.first_prediction_seconds is not None:
+            report["process_start_to_first_prediction_seconds"] = self.process_age_at_start + self.first_prediction_seconds
+        return report
+
+    def take_report(self):
+        """The report, once, on the first invocation that made a prediction, otherwise None."""
+        if self.reported or self.first_prediction_seconds is None:
+            return None
+        self.reported = True
+        return self.report()
@@ -0,0 +1,209 @@
+import numpy as np
+
+import batch
+import instrumentation
+
+# Bounded memory scoring of S3 objects of any size. The input is read with ranged
+# GETs of chunk_bytes, rows are scored block_rows at a time as NumPy blocks and the
+# output is pushed to S3 as multipart upload parts as soon as a part is full, so
+# peak memory depends on the chunk, block and part sizes and not on the input size.
+
+MiB = 1024 * 1024
+DEFAULT_CHUNK_BYTES = 8 * MiB
+DEFAULT_PART_BYTES = 8 * MiB
+DEFAULT_BLOCK_ROWS = 50000
+# S3 rejects multipart parts smaller than this, except for the last one
+MIN_PART_BYTES = 5 * MiB
+
+
+def object_size(client, bucket, key):
+    return client.head_object(Bucket=bucket, Key=key)["ContentLength"]
+
+
+def iter_lines(client, bucket, key, start=0, end=None, chunk_bytes=DEFAULT_CHUNK_BYTES, size=None):
+    """Yield the lines of s3://bucket/key that start inside the byte range [start, end).
+
+    A line belongs to the range containing its first byte, so a line crossing the
+    end offset is read to completion and a line crossing the start offset is left
+    to the previous range. Consecutive ranges therefore yield every line exactly once.
+    """
+    if size is None:
+        size = object_size(client, bucket, key)
+    end = size if end is None else min(end, size)
+    # Start one byte early so a line starting exactly at `start` is recognised
+    position = max(start - 1, 0)
+    line_start = position
+    skip_first = start > 0
+    pending = b""
+
+    while position < size and line_start < end:
+        last = min(position + chunk_bytes, size) - 1
+        chunk = client.get_object(Bucket=bucket, Key=key, Range="bytes="+str(position)+"-"+str(last))["Body"].read()
+        position = last + 1
+
+        lines = (pending + chunk).split(b"\n")
+        pending = lines.pop()
+        for line in lines:
+            if line_start >= end:
+                return
+            line_start += len(line) + 1
+            if skip_first:
+                skip_first = False
+                continue
+            yield line
+
+    if pending and line_start < end and not skip_first:
+        yield pending
+
+
+def read_header(client, bucket, key, chunk_bytes=64 * 1024):
+    for line in iter_lines(client, bucket, key, start=0, end=1, chunk_bytes=chunk_bytes):
+        return line.decode().strip()
+    raise ValueError("s3://"+bucket+"/"+key+" is empty")
+
+
+def iter_blocks(lines, block_rows):
+    block = []
+    for line in lines:
+        if not line.strip():
+            continue
+        block.append(line)
+        if len(block) == block_rows:
+            yield block
+            block = []
+    if block:
+        yield block
+
+
+class MultipartWriter:
+    """File-like writer that uploads to S3 in parts as the buffer fills up.
+
+    Output smaller than one part is written with a single put_object so small
+    results do not pay for a multipart upload.
+    """
+
+    def __init__(self, client, bucket, key, part_bytes=DEFAULT_PART_BYTES):
+        if part_bytes < MIN_PART_BYTES:
+            raise ValueError("part_bytes must be at least "+str(MIN_PART_BYTES))
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_bytes = part_bytes
+        self.upload_id = None
+        self.parts = []
+        self.bytes_written = 0
+        self._buffer = bytearray()
+
+    def write(self, data):
+        self._buffer += data
+        self.bytes_written += len(data)
+        if len(self._buffer) >= self.part_bytes:
+            self._upload_part(bytes(self._buffer))
+            self._buffer = bytearray()
+
+    def _upload_part(self, data):
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key)["UploadId"]
+        part_number = len(self.parts) + 1
+        response = self.client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            PartNumber=part_number, Body=data
+        )
+        self.parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+
+    def close(self):
+        if self.upload_id is None:
+            self.client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self._buffer))
+        else:
+            if self._buffer:
+                self._upload_part(bytes(self._buffer))
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                MultipartUpload={"Parts": self.parts}
+            )
+        self._buffer = bytearray()
+
+    def abort(self):
+        if self.upload_id is not None:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        self._buffer = bytearray()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def _csv_block(block, header, feature_columns):
+    columns = header.split(",")
+    feature_idx = [columns.index(column) for column in feature_columns]
+    text = [line.decode() for line in block]
+    matrix = np.loadtxt(text, delimiter=",", usecols=feature_idx, dtype=np.float32, ndmin=2)
+    if "Id" in columns:
+        ids = np.loadtxt(text, delimiter=",", usecols=[columns.index("Id")], dtype=str, ndmin=1).tolist()
+    else:
+        ids = [None] * len(text)
+    return ids, matrix
+
+
+def _format_csv(ids, prediction):
+    return "".join(
+        (str(ids[row]) + "," if ids[row] is not None else "") + str(label) + "\n"
+        for row, label in enumerate(prediction)
+    ).encode()
+
+
+def score_stream(client, model, bucket, key, output_bucket, output_key, feature_columns,
+        input_format="csv", start=0, end=None, probabilities=False,
+        block_rows=DEFAULT_BLOCK_ROWS, chunk_bytes=DEFAULT_CHUNK_BYTES, part_bytes=DEFAULT_PART_BYTES,
+        metrics=None):
+    """Score the rows of s3://bucket/key in [start, end) and write them to output_key.
+
+    CSV input needs a header line naming the feature columns, it is read from the
+    start of the object so that shards starting mid-object can be parsed too. CSV
+    output has one "Id,prediction" (or "prediction") line per row, JSON lines input
+    produces JSON lines output in the batch result format. Stage times, rows and
+    bytes are recorded in metrics when given.
+    """
+    metrics = metrics or instrumentation.Metrics(enabled=False)
+    size = object_size(client, bucket, key)
+    header = read_header(client, bucket, key) if input_format == "csv" else None
+    lines = iter_lines(client, bucket, key, start=start, end=end, chunk_bytes=chunk_bytes, size=size)
+    if header is not None and start == 0:
+        next(lines, None)
+
+    rows = 0
+    with MultipartWriter(client, output_bucket, output_key, part_bytes=part_bytes) as writer:
+        for block in iter_blocks(lines, block_rows):
+            with metrics.timer("ParseTime"):
+                if header is not None:
+                    ids, matrix = _csv_block(block, header, feature_columns)
+                else:
+                    ids, matrix = batch.parse_jsonl(b"\n".join(block), feature_columns)
+
+            with metrics.timer("PredictTime"):
+                prediction, proba = batch.predict_batch(model, matrix, probabilities and header is None)
+            with metrics.timer("SerializeTime"):
+                if header is not None:
+                    output = _format_csv(ids, prediction)
+                else:
+                    output = batch.to_jsonl(batch.format_results(ids, prediction, proba, model.classes_))
+            # parts are uploaded from inside write, the S3 reads happen while iterating
+            with metrics.timer("S3UploadTime"):
+                writer.write(output)
+            rows += len(block)
+
+    metrics.count("RowsProcessed", rows)
+    # the byte range scored, the line crossing its end adds a few more bytes
+    metrics.count("BytesDownloaded", (size if end is None else min(end, size)) - start, instrumentation.BYTES)
+    metrics.count("BytesUploaded", writer.bytes_written, instrumentation.BYTES)
+    return {
+        "rows": rows,
+        "parts": len(writer.parts),
+        "bytes_written": writer.bytes_written,
+        "output_s3": {"bucket": output_bucket, "key": output_key}
+    }
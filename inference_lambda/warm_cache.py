@@ -0,0 +1,168 @@
+import os
+import time
+from collections import OrderedDict
+
+import boto3
+from botocore.exceptions import ClientError
+
+import s3_io
+
+# Process level cache that survives between invocations of a warm Lambda container.
+# S3 backed entries are revalidated with a conditional GET (If-None-Match on the
+# stored ETag) once their TTL has expired, so an unchanged object is never
+# downloaded or parsed twice. Entries are evicted least recently used first when
+# the cache or the process grows past its memory budget.
+
+
+def _current_rss_bytes():
+    # /proc is always available on the Lambda runtime, fall back to 0 elsewhere
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def _sizeof(value, default):
+    if hasattr(value, "memory_usage"):
+        return int(value.memory_usage(deep=True).sum())
+    if hasattr(value, "nbytes"):
+        return int(value.nbytes)
+    if isinstance(value, tuple) and value and all(hasattr(item, "nbytes") for item in value):
+        return sum(int(item.nbytes) for item in value)
+    return default
+
+
+class CacheEntry:
+
+    def __init__(self, value, size, etag=None, mtime=None):
+        self.value = value
+        self.size = size
+        self.etag = etag
+        self.mtime = mtime
+        self.validated_at = time.monotonic()
+
+
+class WarmCache:
+
+    def __init__(self, ttl_seconds=300.0, max_bytes=None, rss_limit_bytes=None):
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.rss_limit_bytes = rss_limit_bytes
+        self._resources = {}
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.evictions = 0
+
+    @classmethod
+    def from_environment(cls):
+        # Budgets are derived from the function memory size so that the cache
+        # shrinks with the container rather than pushing it into an OOM kill
+        memory_mb = int(os.environ.get("AWS_LAMBDA_FUNCTION_MEMORY_SIZE", "0"))
+        cache_fraction = float(os.environ.get("CACHE_MEMORY_FRACTION", "0.5"))
+        rss_fraction = float(os.environ.get("CACHE_RSS_HIGH_WATERMARK", "0.8"))
+        memory_bytes = memory_mb * 1024 * 1024
+        return cls(
+            ttl_seconds=float(os.environ.get("CACHE_TTL_SECONDS", "300")),
+            max_bytes=int(memory_bytes * cache_fraction) or None,
+            rss_limit_bytes=int(memory_bytes * rss_fraction) or None
+        )
+
+    def resource(self, service_name):
+        if service_name not in self._resources:
+            # S3 goes through the shared client with its tuned connection pool
+            self._resources[service_name] = s3_io.resource() if service_name == "s3" else boto3.resource(service_name)
+        return self._resources[service_name]
+
+    def get_s3_object(self, bucket, key, loader):
+        """Return loader(body_bytes) for s3://bucket/key, reusing the cached value
+        while it is fresh or while S3 reports the object as not modified."""
+        cache_key = ("s3", bucket, key)
+        entry = self._entries.get(cache_key)
+        if entry is not None:
+            if time.monotonic() - entry.validated_at < self.ttl_seconds:
+                return self._hit(cache_key, entry)
+            try:
+                response = self.resource("s3").meta.client.get_object(
+                    Bucket=bucket, Key=key, IfNoneMatch=entry.etag
+                )
+            except ClientError as error:
+                if error.response["ResponseMetadata"].get("HTTPStatusCode") != 304:
+                    raise
+                self.revalidations += 1
+                entry.validated_at = time.monotonic()
+                return self._hit(cache_key, entry)
+        else:
+            response = self.resource("s3").meta.client.get_object(Bucket=bucket, Key=key)
+
+        body = response["Body"].read()
+        value = loader(body)
+        entry = CacheEntry(
+            value,
+            _sizeof(value, len(body)),
+            etag=response.get("ETag")
+        )
+        return self._miss(cache_key, entry)
+
+    def get_file(self, path, loader):
+        """Return loader(path) for a local file, reloading only when its mtime changes."""
+        cache_key = ("file", path)
+        stat = os.stat(path)
+        entry = self._entries.get(cache_key)
+        if entry is not None and entry.mtime == stat.st_mtime_ns:
+            return self._hit(cache_key, entry)
+
+        value = loader(path)
+        entry = CacheEntry(value, _sizeof(value, stat.st_size), mtime=stat.st_mtime_ns)
+        return self._miss(cache_key, entry)
+
+    def invalidate(self, *cache_key):
+        self._entries.pop(cache_key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "revalidations": self.revalidations,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self.total_bytes()
+        }
+
+    def total_bytes(self):
+        return sum(entry.size for entry in self._entries.values())
+
+    def _hit(self, cache_key, entry):
+        self.hits += 1
+        self._entries.move_to_end(cache_key)
+        return entry.value
+
+    def _miss(self, cache_key, entry):
+        self.misses += 1
+        self._entries[cache_key] = entry
+        self._entries.move_to_end(cache_key)
+        self._evict_if_needed()
+        return entry.value
+
+    def _evict_if_needed(self):
+        # Freed arrays are not always handed back to the OS, so the RSS is read
+        # once and only as many cache bytes as it is over the limit are evicted
+        # rather than evicting until the RSS drops. The entry just inserted, the
+        # most recently used one, is always kept.
+        rss_excess = 0
+        if self.rss_limit_bytes is not None:
+            rss_excess = _current_rss_bytes() - self.rss_limit_bytes
+        total = self.total_bytes()
+        while len(self._entries) > 1:
+            over_max_bytes = self.max_bytes is not None and total > self.max_bytes
+            if not over_max_bytes and rss_excess <= 0:
+                break
+            _, entry = self._entries.popitem(last=False)
+            total -= entry.size
+            rss_excess -= entry.size
+            self.evictions += 1
@@ -0,0 +1,158 @@
+import datetime
+import math
+import os
+
+import instrumentation
+import s3_io
+
+# Split and merge steps of the batch-inference state machine. The splitter cuts the
+# input object into byte ranges, the Step Functions Map state invokes the inference
+# Lambda once per range ("stream" event) and the merge step concatenates the per
+# shard outputs, in shard order, into a single object.
+
+MiB = 1024 * 1024
+DEFAULT_SHARD_BYTES = 64 * MiB
+DEFAULT_MAX_SHARDS = 500
+# S3 rejects multipart parts smaller than this, except for the last one
+MIN_PART_BYTES = 5 * MiB
+
+client = s3_io.client()
+metrics = instrumentation.Metrics.from_environment()
+
+
+def plan_shards(size, shard_bytes=DEFAULT_SHARD_BYTES, max_shards=DEFAULT_MAX_SHARDS):
+    """Cut [0, size) into contiguous byte ranges of at most shard_bytes each.
+
+    Shards grow past shard_bytes when needed to stay within max_shards, which keeps
+    the split output under the Step Functions payload limit. The state machine
+    replaces the shard events with the (smaller) shard results, so the state
+    after the Map stays under it too.
+    """
+    if size == 0:
+        return [{"start": 0, "end": 0}]
+    shard_bytes = max(shard_bytes, math.ceil(size / max_shards))
+    return [
+        {"start": start, "end": min(start + shard_bytes, size)}
+        for start in range(0, size, shard_bytes)
+    ]
+
+
+def split(s3, event):
+    bucket = event["bucket"]
+    key = event["key"]
+    input_format = event.get("format", "jsonl" if key.endswith(".jsonl") else "csv")
+    output_bucket = event.get("output_bucket") or os.environ["INFERENCE_RESULTS_BUCKET"]
+    output_prefix = event.get("output_prefix") or "batch-inference/"+datetime.datetime.now().strftime('%m-%d-%Y %H-%M-%S')+"/"
+
+    size = s3.head_object(Bucket=bucket, Key=key)["ContentLength"]
+    ranges = plan_shards(
+        size,
+        shard_bytes=int(event.get("shard_bytes", DEFAULT_SHARD_BYTES)),
+        max_shards=int(event.get("max_shards", DEFAULT_MAX_SHARDS))
+    )
+
+    shards = []
+    for index, byte_range in enumerate(ranges):
+        shards.append({"stream": {
+            "bucket": bucket,
+            "key": key,
+            "format": input_format,
+            "start": byte_range["start"],
+            "end": byte_range["end"],
+            "output_bucket": output_bucket,
+            "output_key": output_prefix+"shards/part-"+str(index).zfill(5)+"."+input_format
+        }})
+
+    return {
+        "shards": shards,
+        "output": {"bucket": output_bucket, "key": output_prefix+"prediction."+input_format}
+    }
+
+
+def merge(s3, parts, output):
+    """Concatenate the part objects, in order, into output["key"].
+
+    Parts of at least MIN_PART_BYTES are copied server side with upload_part_copy,
+    smaller ones are read and buffered until they make up a valid part.
+    """
+    bucket = output["bucket"]
+    key = output["key"]
+    upload_id = None
+    uploaded = []
+    buffer = bytearray()
+    rows = 0
+
+    def next_part(**kwargs):
+        nonlocal upload_id
+        if upload_id is None:
+            upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key)["UploadId"]
+        part_number = len(uploaded) + 1
+        if "CopySource" in kwargs:
+            etag = s3.upload_part_copy(Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=part_number, **kwargs)["CopyPartResult"]["ETag"]
+        else:
+            etag = s3.upload_part(Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=part_number, **kwargs)["ETag"]
+        uploaded.append({"ETag": etag, "PartNumber": part_number})
+
+    try:
+        for part in parts:
+            rows += part.get("rows", 0)
+            source = part["output_s3"]
+            size = s3.head_object(Bucket=source["bucket"], Key=source["key"])["ContentLength"]
+            if not buffer and size >= MIN_PART_BYTES:
+                next_part(CopySource={"Bucket": source["bucket"], "Key": source["key"]})
+                continue
+            buffer += s3.get_object(Bucket=source["bucket"], Key=source["key"])["Body"].read()
+            if len(buffer) >= MIN_PART_BYTES:
+                next_part(Body=bytes(buffer))
+                buffer = bytearray()
+
+        if upload_id is None:
+            s3.put_object(Bucket=bucket, Key=key, Body=bytes(buffer))
+        else:
+            if buffer:
+                next_part(Body=bytes(buffer))
+            s3.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id, MultipartUpload={"Parts": uploaded})
+    except Exception:
+        if upload_id is not None:
+            s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+
+    return {"rows": rows, "shards": len(parts), "output_s3": output}
+
+
+def run_local(event, score, s3=client, executor=None):
+    """Run split, score and merge in process, standing in for the state machine.
+
+    score is called with each shard event, e.g. inference.handler bound to a None
+    context, sequentially or through executor.map when an executor is given.
+    """
+    plan = split(s3, event)
+    if executor is None:
+        parts = [score(shard) for shard in plan["shards"]]
+    else:
+        parts = list(executor.map(score, plan["shards"]))
+    return merge(s3, parts, plan["output"])
+
+
+def split_handler(event, context):
+    print(event)
+    metrics.begin()
+    try:
+        plan = split(client, event)
+        metrics.count("Shards", len(plan["shards"]))
+        return plan
+    finally:
+        metrics.flush()
+
+
+def merge_handler(event, context):
+    print(event)
+    metrics.begin()
+    try:
+        with metrics.timer("MergeTime"):
+            response = merge(client, event["parts"], event["output"])
+        metrics.count("RowsProcessed", response["rows"])
+        metrics.count("Shards", response["shards"])
+        return response
+    finally:
+        metrics.flush()
@@ -1,43 +1,131 @@
-import os
 import time
-import csv
 import json
+import random
 import boto3
-from datetime import datetime
+
+import instrumentation
 
 client = boto3.client('codebuild')
+sfn_client = boto3.client('stepfunctions')
+
+# Build statuses CodeBuild reports once a build is over
+FINAL_STATUSES = ['SUCCEEDED', 'FAILED', 'FAULT', 'STOPPED', 'TIMED_OUT']
+# Environment variable carrying the Step Functions task token through the build
+TASK_TOKEN_VARIABLE = 'SFN_TASK_TOKEN'
+INITIAL_POLL_SECONDS = 5
+MAX_POLL_SECONDS = 60
+# Time kept back from the Lambda timeout to report the still running builds
+DEADLINE_MARGIN_SECONDS = 15
+
+metrics = instrumentation.Metrics.from_environment()
+
+
+def start_builds(project_names, environment=None, task_token=None):
+    """Start one build per project, all running at once, and return their ids."""
+    variables = [{'name': name, 'value': str(value), 'type': 'PLAINTEXT'} for name, value in (environment or {}).items()]
+    if task_token:
+        variables.append({'name': TASK_TOKEN_VARIABLE, 'value': task_token, 'type': 'PLAINTEXT'})
+
+    ids = []
+    for project_name in project_names:
+        kwargs = {'projectName': project_name}
+        if variables:
+            kwargs['environmentVariablesOverride'] = variables
+        ids.append(client.start_build(**kwargs)['build']['id'])
+    return ids
+
+
+def wait_for_builds(ids, deadline=None, initial_delay=INITIAL_POLL_SECONDS, max_delay=MAX_POLL_SECONDS, sleep=time.sleep):
+    """Poll every build with a single batch_get_builds call per round until all finish.
+
+    The delay between rounds doubles up to max_delay with equal jitter, so builds
+    started together do not keep polling in lock step. Raises when a build does
+    not succeed or when deadline (a time.monotonic() value) would be passed.
+    """
+    pending = list(ids)
+    finished = {}
+    delay = initial_delay
+    while pending:
+        metrics.count('PollRequests')
+        for build in client.batch_get_builds(ids=pending)['builds']:
+            if build['buildStatus'] in FINAL_STATUSES:
+                finished[build['id']] = build
+        pending = [build_id for build_id in pending if build_id not in finished]
+        if not pending:
+            break
+        if deadline is not None and time.monotonic() + delay > deadline:
+            raise Exception("codebuild builds " + str(pending) + " still running at the Lambda deadline")
+        sleep(delay / 2 + random.uniform(0, delay / 2))
+        delay = min(max_delay, delay * 2)
+
+    failed = [build for build in finished.values() if build['buildStatus'] != 'SUCCEEDED']
+    if failed:
+        raise Exception("codebuild project " + str(failed[0]) + " did not succeed")
+    return [finished[build_id] for build_id in ids]
+
+
+def build_summary(build):
+    return {'project_name': build['projectName'], 'id': build['id'], 'status': build['buildStatus']}
+
 
 def handler(event, context):
-    # Log trigger event and environment
+    # Log trigger event
+    print(event)
+    metrics.begin()
+    try:
+        return _handle(event, context)
+    finally:
+        metrics.flush()
+
+
+def _handle(event, context):
+    project_names = event.get('project_names') or [event['project_name']]
+    task_token = event.get('task_token')
+    # the first build to finish would close the task while the others still run
+    if task_token and len(project_names) > 1:
+        raise Exception("a task token waits on a single build, got projects " + str(project_names))
+
+    ids = start_builds(project_names, event.get('environment'), task_token)
+    metrics.count('BuildsStarted', len(ids))
+    metrics.set_property('builds', ids)
+
+    # With a task token the state machine waits for build_state_change_handler to
+    # complete the task, nothing has to stay around to poll
+    if task_token:
+        return {'builds': ids}
+
+    deadline = None
+    if context is not None:
+        deadline = time.monotonic() + context.get_remaining_time_in_millis() / 1000 - DEADLINE_MARGIN_SECONDS
+    with metrics.timer('BuildWaitTime'):
+        builds = wait_for_builds(ids, deadline=deadline)
+    return {'builds': [build_summary(build) for build in builds]}
+
+
+def build_state_change_handler(event, context):
+    # Invoked by the EventBridge rule for "CodeBuild Build State Change" events,
+    # completes the Step Functions task waiting on the build's task token
     print(event)
-    print(os.environ)
-
-    project_name=event["project_name"]
-
-    response = client.start_build(
-        projectName=project_name
-    )
-
-    id=response['build']['id']
-
-    is_running = True
-
-    while is_running:
-        response = client.batch_get_builds(
-            ids=[
-                id
-            ]
-        )
-
-        build_status=response['builds'][0]['buildStatus']
-        print(build_status)
-        if build_status == 'IN_PROGRESS':
-            time.sleep(5)
-        elif build_status == 'SUCCEEDED':
-            is_running = False
-            doreturn = True
-        else:
-            raise Exception("codebuild project" + str(response['builds'][0]) + "did not succeed")
-    
-    if doreturn:
-        return project_name + " for "+ site_id + " succeeded."
+    metrics.begin()
+    try:
+        _complete_task(event['detail'])
+    finally:
+        metrics.flush()
+
+
+def _complete_task(detail):
+    variables = detail.get('additional-information', {}).get('environment', {}).get('environment-variables', [])
+    task_token = next((variable['value'] for variable in variables if variable['name'] == TASK_TOKEN_VARIABLE), None)
+    if task_token is None:
+        print("build " + detail['build-id'] + " was not started by a waiting state machine")
+        return
+
+    status = detail['build-status']
+    summary = {'project_name': detail['project-name'], 'id': detail['build-id'], 'status': status}
+    metrics.set_property('build', summary)
+    metrics.count('Builds' + status.title().replace('_', ''))
+    if status == 'SUCCEEDED':
+        sfn_client.send_task_success(taskToken=task_token, output=json.dumps(summary))
+    elif status in FINAL_STATUSES:
+        sfn_client.send_task_failure(taskToken=task_token, error='CodeBuild.' + status,
+            cause="codebuild project " + detail['project-name'] + " build " + detail['build-id'] + " did not succeed")
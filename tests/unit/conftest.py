@@ -0,0 +1,51 @@
+import os
+import sys
+
+import boto3
+import pytest
+from moto import mock_aws
+
+# The Lambda sources are flat directories copied into their images rather than
+# packages, put them on the path so the tests can import them the same way
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+for source_dir in ["inference_lambda", "training_image_asset", "lambdas", "common"]:
+    path = os.path.join(ROOT, source_dir)
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+_session_environment = pytest.MonkeyPatch()
+
+
+def pytest_configure(config):
+    # Lambda modules create their boto3 clients at import, so the region has to be
+    # set before the test modules are collected. It is undone after the session.
+    if "AWS_DEFAULT_REGION" not in os.environ:
+        _session_environment.setenv("AWS_DEFAULT_REGION", "us-east-1")
+
+
+def pytest_unconfigure(config):
+    _session_environment.undo()
+
+
+@pytest.fixture
+def bucket():
+    """Name of the bucket the s3 fixture creates, modules override it with their own."""
+    return "bucket"
+
+
+@pytest.fixture
+def s3(monkeypatch, bucket):
+    """A moto backed S3 resource with an empty bucket."""
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    with mock_aws():
+        resource = boto3.resource("s3")
+        resource.create_bucket(Bucket=bucket)
+        yield resource
+
+
+@pytest.fixture
+def s3_client(s3):
+    return s3.meta.client
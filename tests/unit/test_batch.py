@@ -0,0 +1,74 @@
+import json
+
+import numpy as np
+import pytest
+from sklearn.neighbors import KNeighborsClassifier
+
+import batch
+
+FEATURE_COLUMNS = ['SepalLengthCm','SepalWidthCm','PetalLengthCm','PetalWidthCm']
+
+
+def test_records_parse_into_contiguous_float32_matrix():
+    records = [
+        [5.1, 3.5, 1.4, 0.2],
+        {"id": "b", "SepalLengthCm": 6.7, "SepalWidthCm": 3.0, "PetalLengthCm": 5.2, "PetalWidthCm": 2.3},
+        {"features": [5.9, 3.0, 4.2, 1.5]}
+    ]
+
+    ids, matrix = batch.parse_records(records, FEATURE_COLUMNS)
+
+    assert ids == [None, "b", None]
+    assert matrix.dtype == np.float32
+    assert matrix.flags["C_CONTIGUOUS"]
+    np.testing.assert_allclose(matrix[1], [6.7, 3.0, 5.2, 2.3], rtol=1e-6)
+
+
+def test_jsonl_skips_blank_lines_and_rejects_short_rows():
+    body = b'{"id": 1, "features": [1, 2, 3, 4]}\n\n[5, 6, 7, 8]\n'
+    ids, matrix = batch.parse_jsonl(body, FEATURE_COLUMNS)
+    assert ids == [1, None]
+    assert matrix.shape == (2, 4)
+
+    with pytest.raises(ValueError):
+        batch.parse_jsonl(b"[1, 2, 3]\n", FEATURE_COLUMNS)
+
+
+def test_batch_is_scored_in_one_call():
+    model = KNeighborsClassifier(n_neighbors=1).fit(
+        np.array([[0, 0, 0, 0], [10, 10, 10, 10]]), np.array(["small", "large"])
+    )
+    ids, matrix = batch.parse_records([[1, 1, 1, 1], [9, 9, 9, 9]], FEATURE_COLUMNS)
+
+    prediction, proba = batch.predict_batch(model, matrix, probabilities=True)
+    results = batch.format_results(ids, prediction, proba, model.classes_)
+
+    assert [result["prediction"] for result in results] == ["small", "large"]
+    assert results[0]["probabilities"] == {"large": 0.0, "small": 1.0}
+    assert json.loads(batch.to_jsonl(results).splitlines()[1])["prediction"] == "large"
+
+
+def test_probabilities_come_from_a_single_neighbour_search():
+    model = KNeighborsClassifier(n_neighbors=3).fit(
+        np.array([[0, 0, 0, 0], [1, 1, 1, 1], [10, 10, 10, 10], [11, 11, 11, 11]]), np.array(["small", "small", "large", "large"])
+    )
+    _, matrix = batch.parse_records([[1, 1, 1, 1], [9, 9, 9, 9], [5, 5, 5, 5]], FEATURE_COLUMNS)
+    calls = []
+    model.predict = lambda matrix: calls.append("predict")
+    original_proba = model.predict_proba
+    model.predict_proba = lambda matrix: calls.append("predict_proba") or original_proba(matrix)
+
+    prediction, proba = batch.predict_batch(model, matrix, probabilities=True)
+
+    assert calls == ["predict_proba"]
+    assert prediction.tolist() == KNeighborsClassifier.predict(model, matrix).tolist()
+
+
+def test_csv_parses_features_and_labels_without_pandas():
+    body = b"Id,SepalLengthCm,SepalWidthCm,PetalLengthCm,PetalWidthCm,Species\n1,5.1,3.5,1.4,0.2,Iris-setosa\n2,6.7,3.0,5.2,2.3,Iris-virginica\n\n"
+
+    matrix, labels = batch.parse_csv(body, FEATURE_COLUMNS, label_column="Species")
+
+    assert matrix.dtype == np.float64
+    np.testing.assert_array_equal(matrix, [[5.1, 3.5, 1.4, 0.2], [6.7, 3.0, 5.2, 2.3]])
+    assert labels.tolist() == ["Iris-setosa", "Iris-virginica"]
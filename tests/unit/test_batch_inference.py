@@ -0,0 +1,94 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+from sklearn.neighbors import KNeighborsClassifier
+
+import batch_inference_lambda
+import streaming
+
+FEATURE_COLUMNS = ['SepalLengthCm','SepalWidthCm','PetalLengthCm','PetalWidthCm']
+
+
+def test_plan_shards_covers_the_object_within_max_shards():
+    shards = batch_inference_lambda.plan_shards(1000, shard_bytes=64, max_shards=10)
+
+    assert len(shards) == 10
+    assert shards[0]["start"] == 0
+    assert shards[-1]["end"] == 1000
+    assert all(a["end"] == b["start"] for a, b in zip(shards, shards[1:]))
+
+
+@pytest.mark.parametrize("executor", [None, ThreadPoolExecutor(max_workers=4)])
+def test_sharded_run_matches_single_pass(s3_client, executor):
+    rng = np.random.default_rng(1)
+    features = rng.uniform(0, 8, size=(2000, 4)).round(2)
+    labels = np.where(features[:, 2] > 4, "versicolor", "setosa")
+    lines = ["Id,SepalLengthCm,SepalWidthCm,PetalLengthCm,PetalWidthCm"]
+    lines += [",".join([str(i)] + [str(v) for v in row]) for i, row in enumerate(features)]
+    s3_client.put_object(Bucket="bucket", Key="input.csv", Body="\n".join(lines).encode())
+    model = KNeighborsClassifier(n_neighbors=3).fit(features, labels)
+
+    def score(shard):
+        source = shard["stream"]
+        return streaming.score_stream(
+            s3_client, model, source["bucket"], source["key"], source["output_bucket"], source["output_key"],
+            FEATURE_COLUMNS, start=source["start"], end=source["end"], block_rows=100, chunk_bytes=512
+        )
+
+    response = batch_inference_lambda.run_local(
+        {"bucket": "bucket", "key": "input.csv", "output_bucket": "bucket", "output_prefix": "out/", "shard_bytes": 4096},
+        score, s3=s3_client, executor=executor
+    )
+
+    merged = s3_client.get_object(Bucket="bucket", Key="out/prediction.csv")["Body"].read().decode().splitlines()
+    assert response["rows"] == 2000
+    assert response["shards"] > 1
+    assert merged == [str(i) + "," + label for i, label in enumerate(model.predict(features))]
+
+
+def test_merge_copies_large_parts_server_side(s3_client):
+    big = b"a" * batch_inference_lambda.MIN_PART_BYTES
+    s3_client.put_object(Bucket="bucket", Key="p0", Body=big)
+    s3_client.put_object(Bucket="bucket", Key="p1", Body=b"b" * 10)
+    s3_client.put_object(Bucket="bucket", Key="p2", Body=b"c" * 10)
+    parts = [{"rows": 1, "output_s3": {"bucket": "bucket", "key": key}} for key in ["p0", "p1", "p2"]]
+
+    response = batch_inference_lambda.merge(s3_client, parts, {"bucket": "bucket", "key": "merged"})
+
+    assert response["rows"] == 3
+    assert s3_client.get_object(Bucket="bucket", Key="merged")["Body"].read() == big + b"b" * 10 + b"c" * 10
+
+
+class SizedObject:
+
+    def __init__(self, size):
+        self.size = size
+
+    def head_object(self, Bucket, Key):
+        return {"ContentLength": self.size}
+
+
+def test_state_stays_under_the_step_functions_limit_at_max_shards():
+    # Step Functions rejects state data over 256 KiB with States.DataLimitExceeded
+    limit = 256 * 1024
+    event = {
+        "bucket": "acme-analytics-batch-inference-input-us-east-1-123456789012",
+        "key": "exports/iris-measurements/2022/09/01/full-export-part-0001-of-0001.jsonl",
+        "output_bucket": "acme-analytics-batch-inference-output-us-east-1-123456789012",
+        "output_prefix": "batch-inference/iris-measurements/2022-09-01T10-00-00/"
+    }
+    plan = batch_inference_lambda.split(SizedObject(200 * 1024 ** 3), event)
+    assert len(plan["shards"]) == batch_inference_lambda.DEFAULT_MAX_SHARDS
+
+    # the fields the score-shard result_selector keeps, written over $.split.shards
+    results = [
+        {"output_s3": {"bucket": shard["stream"]["output_bucket"], "key": shard["stream"]["output_key"]}, "rows": 10 ** 9}
+        for shard in plan["shards"]
+    ]
+    after_split = dict(event, split=plan)
+    after_map = dict(event, split=dict(plan, shards=results))
+
+    assert len(json.dumps(after_split)) < limit
+    assert len(json.dumps(after_map)) < limit
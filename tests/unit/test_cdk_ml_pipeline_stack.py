@@ -13,3 +13,52 @@ def test_sqs_queue_created():
 #     template.has_resource_properties("AWS::SQS::Queue", {
 #         "VisibilityTimeout": 300
 #     })
+
+
+def test_batch_inference_state_machine_created():
+    app = core.App()
+    stack = CdkMlPipelineStack(app, "cdk-ml-pipeline")
+    template = assertions.Template.from_stack(stack)
+
+    template.has_resource_properties("AWS::StepFunctions::StateMachine", {
+        "StateMachineName": "batch-inference-pipeline"
+    })
+    template.has_resource_properties("AWS::Lambda::Function", {
+        "Handler": "batch_inference_lambda.split_handler"
+    })
+    # the shard results replace the shard events instead of being added next to them
+    template.has_resource_properties("AWS::StepFunctions::StateMachine", {
+        "StateMachineName": "batch-inference-pipeline",
+        "DefinitionString": {"Fn::Join": ["", assertions.Match.array_with([
+            assertions.Match.string_like_regexp('"ResultPath":"\\$.split.shards"')
+        ])]}
+    })
+
+
+def test_retrain_pipeline_skips_deploy_for_unchanged_model():
+    app = core.App()
+    stack = CdkMlPipelineStack(app, "cdk-ml-pipeline")
+    template = assertions.Template.from_stack(stack)
+
+    template.has_resource_properties("AWS::StepFunctions::StateMachine", {
+        "StateMachineName": "retrain-pipeline",
+        "DefinitionString": {"Fn::Join": ["", assertions.Match.array_with([
+            assertions.Match.string_like_regexp('"model-changed":\\{"Type":"Choice"')
+        ])]}
+    })
+
+
+def test_codebuild_steps_wait_for_build_state_change_events():
+    app = core.App()
+    stack = CdkMlPipelineStack(app, "cdk-ml-pipeline")
+    template = assertions.Template.from_stack(stack)
+
+    template.has_resource_properties("AWS::Events::Rule", {
+        "EventPattern": assertions.Match.object_like({
+            "source": ["aws.codebuild"],
+            "detail-type": ["CodeBuild Build State Change"]
+        })
+    })
+    template.has_resource_properties("AWS::Lambda::Function", {
+        "Handler": "codebuild_helper_lambda.build_state_change_handler"
+    })
@@ -0,0 +1,85 @@
+import pytest
+from botocore.stub import Stubber
+
+import codebuild_helper_lambda
+
+
+def build(build_id, status, project="project"):
+    return {"id": build_id, "buildStatus": status, "projectName": project}
+
+
+@pytest.fixture
+def codebuild():
+    with Stubber(codebuild_helper_lambda.client) as stubber:
+        yield stubber
+        stubber.assert_no_pending_responses()
+
+
+def test_builds_start_together_and_are_polled_in_one_call(codebuild):
+    sleeps = []
+    codebuild.add_response("start_build", {"build": build("a:1", "IN_PROGRESS", "a")}, {"projectName": "a"})
+    codebuild.add_response("start_build", {"build": build("b:1", "IN_PROGRESS", "b")}, {"projectName": "b"})
+    codebuild.add_response("batch_get_builds", {"builds": [build("a:1", "IN_PROGRESS", "a"), build("b:1", "IN_PROGRESS", "b")]}, {"ids": ["a:1", "b:1"]})
+    codebuild.add_response("batch_get_builds", {"builds": [build("a:1", "SUCCEEDED", "a"), build("b:1", "IN_PROGRESS", "b")]}, {"ids": ["a:1", "b:1"]})
+    codebuild.add_response("batch_get_builds", {"builds": [build("b:1", "SUCCEEDED", "b")]}, {"ids": ["b:1"]})
+
+    ids = codebuild_helper_lambda.start_builds(["a", "b"])
+    builds = codebuild_helper_lambda.wait_for_builds(ids, sleep=sleeps.append)
+
+    assert [b["buildStatus"] for b in builds] == ["SUCCEEDED", "SUCCEEDED"]
+    # exponential backoff with equal jitter: 5s then 10s, each between half and all of it
+    assert len(sleeps) == 2
+    assert 2.5 <= sleeps[0] <= 5
+    assert 5 <= sleeps[1] <= 10
+
+
+def test_failed_build_raises(codebuild):
+    codebuild.add_response("start_build", {"build": build("a:1", "IN_PROGRESS")})
+    codebuild.add_response("batch_get_builds", {"builds": [build("a:1", "FAILED")]})
+
+    with pytest.raises(Exception, match="did not succeed"):
+        codebuild_helper_lambda.handler({"project_name": "a"}, None)
+
+
+def test_task_token_mode_returns_without_polling(codebuild):
+    codebuild.add_response("start_build", {"build": build("a:1", "IN_PROGRESS")}, {
+        "projectName": "a",
+        "environmentVariablesOverride": [{"name": "SFN_TASK_TOKEN", "value": "token", "type": "PLAINTEXT"}]
+    })
+
+    assert codebuild_helper_lambda.handler({"project_name": "a", "task_token": "token"}, None) == {"builds": ["a:1"]}
+
+
+def test_task_token_mode_rejects_several_projects(codebuild):
+    with pytest.raises(Exception, match="single build"):
+        codebuild_helper_lambda.handler({"project_names": ["a", "b"], "task_token": "token"}, None)
+
+
+def state_change(status, variables):
+    return {"detail": {
+        "build-status": status,
+        "project-name": "a",
+        "build-id": "arn:a:1",
+        "additional-information": {"environment": {"environment-variables": variables}}
+    }}
+
+
+def test_state_change_completes_the_waiting_task():
+    token = [{"name": "SFN_TASK_TOKEN", "value": "token", "type": "PLAINTEXT"}]
+    with Stubber(codebuild_helper_lambda.sfn_client) as stepfunctions:
+        stepfunctions.add_response("send_task_success", {}, {
+            "taskToken": "token",
+            "output": '{"project_name": "a", "id": "arn:a:1", "status": "SUCCEEDED"}'
+        })
+        stepfunctions.add_response("send_task_failure", {}, {
+            "taskToken": "token",
+            "error": "CodeBuild.FAILED",
+            "cause": "codebuild project a build arn:a:1 did not succeed"
+        })
+
+        codebuild_helper_lambda.build_state_change_handler(state_change("SUCCEEDED", token), None)
+        codebuild_helper_lambda.build_state_change_handler(state_change("FAILED", token), None)
+        # builds started outside a state machine carry no token and are ignored
+        codebuild_helper_lambda.build_state_change_handler(state_change("FAILED", []), None)
+
+        stepfunctions.assert_no_pending_responses()
@@ -0,0 +1,111 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+import model_artifact
+import training
+
+BUCKET = "cdk-ml-pipeline-iris"
+HEADER = "Id,SepalLengthCm,SepalWidthCm,PetalLengthCm,PetalWidthCm,Species\n"
+
+
+@pytest.fixture
+def bucket():
+    return BUCKET
+
+
+@pytest.fixture
+def s3(s3, tmp_path):
+    # a two row model from a full training run as the parent
+    features = np.array([[5.1, 3.5, 1.4, 0.2], [7.0, 3.2, 4.7, 1.4]])
+    model_artifact.write_artifact(str(tmp_path), features, ["Iris-setosa", "Iris-versicolor"], 1, training.FEATURE_COLUMNS)
+    for name in os.listdir(str(tmp_path)):
+        s3.Bucket(BUCKET).upload_file(os.path.join(str(tmp_path), name), "models/latest/artifact/"+name)
+    return s3
+
+
+def put_partition(s3, key, rows):
+    s3.Bucket(BUCKET).put_object(Key=key, Body=(HEADER + "".join(rows)).encode())
+
+
+def latest_manifest(s3):
+    return json.loads(s3.Object(BUCKET, "models/latest/artifact/manifest.json").get()["Body"].read())
+
+
+def test_only_partitions_after_the_watermark_are_appended(s3):
+    put_partition(s3, "data/incremental/001.csv", ["1,6.3,3.3,6.0,2.5,Iris-virginica\n"])
+    put_partition(s3, "data/incremental/002.csv", ["2,5.0,3.6,1.4,0.2,Iris-setosa\n", "3,6.4,3.2,4.5,1.5,Iris-versicolor\n"])
+
+    first = training.incremental_handler(s3, BUCKET, {"incremental": {}})
+
+    assert first["changed"] is True
+    assert first["lineage"]["added_partitions"] == ["data/incremental/001.csv", "data/incremental/002.csv"]
+    manifest = latest_manifest(s3)
+    assert manifest["n_samples"] == 5
+    assert manifest["classes"] == ["Iris-setosa", "Iris-versicolor", "Iris-virginica"]
+    assert manifest["lineage"]["parent_rows"] == 2
+
+    unchanged = training.incremental_handler(s3, BUCKET, {"incremental": {}})
+    assert unchanged["model_hash"] == first["model_hash"]
+    assert "lineage" not in unchanged
+
+    put_partition(s3, "data/incremental/003.csv", ["4,5.9,3.0,5.1,1.8,Iris-virginica\n"])
+    third = training.incremental_handler(s3, BUCKET, {"incremental": {}})
+
+    assert third["lineage"]["added_partitions"] == ["data/incremental/003.csv"]
+    assert third["lineage"]["parent"] == first["model_path"]
+    assert latest_manifest(s3)["n_samples"] == 6
+    watermark = json.loads(s3.Object(BUCKET, "models/watermark.json").get()["Body"].read())
+    assert watermark["last_key"] == "data/incremental/003.csv"
+    assert watermark["rows"] == 4
+
+
+def test_full_training_resets_the_watermark_to_its_model(s3):
+    put_partition(s3, "data/incremental/001.csv", ["1,6.3,3.3,6.0,2.5,Iris-virginica\n"])
+    first = training.incremental_handler(s3, BUCKET, {"incremental": {}})
+
+    # a full run on new data replaces latest/ and starts the lineage over from its model
+    rows = ["{},{},{},{},{},{}\n".format(row + 1, 4.5 + row % 10 * 0.3, 3.0, 1.0 + row % 3 * 2, 0.2 + row % 3, species)
+        for row, species in enumerate(["Iris-setosa", "Iris-versicolor", "Iris-virginica"] * 10)]
+    put_partition(s3, "data/Iris.csv", rows)
+    full = training.handler({}, None)
+    assert full["model_hash"] != first["model_hash"]
+
+    put_partition(s3, "data/incremental/002.csv", ["2,5.0,3.6,1.4,0.2,Iris-setosa\n"])
+    second = training.incremental_handler(s3, BUCKET, {"incremental": {}})
+
+    assert second["lineage"]["parent"] == full["model_path"]
+    # every partition is merged again onto the 21 training rows of the full run
+    assert second["lineage"]["added_partitions"] == ["data/incremental/001.csv", "data/incremental/002.csv"]
+    assert latest_manifest(s3)["n_samples"] == 21 + 2
+
+
+def test_retry_after_a_failed_watermark_write_does_not_append_twice(s3, monkeypatch):
+    put_partition(s3, "data/incremental/001.csv", ["1,6.3,3.3,6.0,2.5,Iris-virginica\n"])
+    write_watermark = training.incremental.write_watermark
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("throttled")
+
+    monkeypatch.setattr(training.incremental, "write_watermark", fail)
+    with pytest.raises(RuntimeError):
+        training.incremental_handler(s3, BUCKET, {"incremental": {}})
+    monkeypatch.setattr(training.incremental, "write_watermark", write_watermark)
+    retried = training.incremental_handler(s3, BUCKET, {"incremental": {}})
+
+    assert retried["lineage"]["parent_rows"] == 2
+    assert latest_manifest(s3)["n_samples"] == 3
+
+
+def test_no_new_partitions_without_a_watermark_reports_no_change(s3):
+    s3.Bucket(BUCKET).put_object(Key=training.IN_USE_HASH_KEY, Body=b"deployed-hash\n")
+
+    result = training.incremental_handler(s3, BUCKET, {"incremental": {}})
+
+    assert result["model_hash"] == "deployed-hash"
+    assert result["changed"] is False
+
+    s3.Bucket(BUCKET).put_object(Key="models/latest/version.json", Body=json.dumps({"model_hash": "deployed-hash"}).encode())
+    assert training.incremental_handler(s3, BUCKET, {"incremental": {}})["model_path"] == "models/deployed-hash/finalized_model.sav"
@@ -0,0 +1,113 @@
+import io
+import json
+
+import pytest
+
+import instrumentation
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        self.now += 0.5
+        return self.now
+
+
+@pytest.fixture
+def fresh_process(monkeypatch):
+    monkeypatch.setattr(instrumentation, "_invocations", 0)
+
+
+def test_invocation_is_written_as_one_emf_line(capsys, fresh_process):
+    metrics = instrumentation.Metrics(function_name="inference-lambda", clock=FakeClock())
+
+    @metrics.timer("PredictTime")
+    def predict():
+        return "prediction"
+
+    assert metrics.begin()
+    metrics.set_dimension("ModelVersion", "abc123")
+    with metrics.timer("S3DownloadTime"):
+        pass
+    assert predict() == "prediction"
+    predict()
+    metrics.count("RowsProcessed", 100)
+    metrics.count("RowsProcessed", 50)
+    metrics.count("BytesUploaded", 2048, instrumentation.BYTES)
+    metrics.set_property("cache", {"hits": 1})
+    metrics.flush()
+
+    documents = instrumentation.parse_emf("log line\n" + capsys.readouterr().out)
+    assert len(documents) == 1
+    document = documents[0]
+    directive = document["_aws"]["CloudWatchMetrics"][0]
+    assert directive["Namespace"] == "CdkMlPipeline"
+    assert directive["Dimensions"] == [["ColdStart", "FunctionName", "ModelVersion"]]
+    assert {metric["Name"]: metric["Unit"] for metric in directive["Metrics"]} == {
+        "S3DownloadTime": "Milliseconds",
+        "PredictTime": "Milliseconds",
+        "RowsProcessed": "Count",
+        "BytesUploaded": "Bytes"
+    }
+    assert document["FunctionName"] == "inference-lambda"
+    assert document["ModelVersion"] == "abc123"
+    assert document["ColdStart"] == "cold"
+    # every timed block takes one 0.5s clock step, the decorated calls add up
+    assert document["S3DownloadTime"] == 500
+    assert document["PredictTime"] == 1000
+    assert document["RowsProcessed"] == 150
+    assert document["cache"] == {"hits": 1}
+
+
+def test_later_invocations_are_warm_and_start_empty(fresh_process):
+    stream = io.StringIO()
+    metrics = instrumentation.Metrics(stream=stream)
+    metrics.begin()
+    metrics.count("RowsProcessed")
+    metrics.flush()
+    assert not metrics.begin()
+    metrics.count("RowsProcessed")
+    metrics.flush()
+    # nothing recorded, nothing written
+    metrics.flush()
+
+    first, second = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert (first["ColdStart"], second["ColdStart"]) == ("cold", "warm")
+    assert second["RowsProcessed"] == 1
+
+
+def test_off_mode_records_and_writes_nothing(monkeypatch, capsys):
+    monkeypatch.setenv("METRICS_MODE", "off")
+    metrics = instrumentation.Metrics.from_environment()
+
+    @metrics.timer("FitTime")
+    def fit():
+        return 1
+
+    metrics.begin()
+    with metrics.timer("S3DownloadTime"):
+        pass
+    assert fit() == 1
+    metrics.count("RowsProcessed", 10)
+    metrics.set_property("accuracy", 1.0)
+
+    assert metrics.flush() is None
+    assert metrics.values == {}
+    assert capsys.readouterr().out == ""
+
+
+def test_model_version_is_read_outside_the_warm_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    import inference
+
+    (tmp_path / "version.json").write_text(json.dumps({"model_hash": "abc123"}))
+    monkeypatch.setenv("MODEL_ARTIFACT_DIR", str(tmp_path))
+    monkeypatch.delenv("MODEL_KEY", raising=False)
+    before = inference.cache.stats()
+
+    assert inference.model_version() == "abc123"
+    assert inference.model_version() == "abc123"
+    assert inference.cache.stats() == before
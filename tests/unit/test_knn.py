@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+from sklearn.neighbors import KNeighborsClassifier
+
+import knn
+
+
+def dataset(n_reference=500, n_queries=200, n_classes=3, seed=0):
+    rng = np.random.default_rng(seed)
+    reference = rng.normal(size=(n_reference, 4))
+    labels = rng.integers(0, n_classes, n_reference)
+    queries = rng.normal(size=(n_queries, 4))
+    return reference, labels, queries
+
+
+@pytest.mark.parametrize("k", [1, 4, 15])
+@pytest.mark.parametrize("weights", ["uniform", "distance"])
+@pytest.mark.parametrize("metric", ["euclidean", "manhattan"])
+def test_predictions_match_sklearn(k, weights, metric):
+    reference, labels, queries = dataset()
+    expected = KNeighborsClassifier(n_neighbors=k, weights=weights, metric=metric, algorithm="brute").fit(reference, labels)
+    # tiny blocks force several query and reference blocks and the top-k merge
+    predictor = knn.KnnPredictor(reference, labels, [0, 1, 2], n_neighbors=k, weights=weights, metric=metric, block_bytes=8 * 1024)
+
+    distances, indices = predictor.kneighbors(queries)
+    expected_distances, expected_indices = expected.kneighbors(queries)
+
+    np.testing.assert_allclose(distances, expected_distances, atol=1e-9)
+    np.testing.assert_array_equal(indices, expected_indices)
+    np.testing.assert_allclose(predictor.predict_proba(queries), expected.predict_proba(queries))
+    np.testing.assert_array_equal(predictor.predict(queries), expected.predict(queries))
+
+
+def test_class_ties_go_to_the_lowest_class_like_sklearn():
+    reference = np.array([[0.0], [1.0], [-1.0], [2.0]])
+    labels = np.array([2, 1, 0, 0])
+    queries = np.array([[0.5], [0.0]])
+    expected = KNeighborsClassifier(n_neighbors=2).fit(reference, labels)
+
+    predictor = knn.KnnPredictor(reference, labels, [0, 1, 2], n_neighbors=2)
+
+    np.testing.assert_array_equal(predictor.predict(queries), expected.predict(queries))
+
+
+def test_exact_matches_take_all_distance_weight():
+    proba = knn.vote(np.array([[0, 1, 1]]), np.array([[0.0, 0.5, 0.5]]), 2, weights="distance")
+    np.testing.assert_array_equal(proba, [[1.0, 0.0]])
+
+
+def test_thread_sharded_and_float32_scoring_agree():
+    reference, labels, queries = dataset(n_reference=2000, n_queries=1000, seed=3)
+    single = knn.KnnPredictor(reference, labels, [0, 1, 2], n_neighbors=5)
+    sharded = knn.KnnPredictor(reference, labels, [0, 1, 2], n_neighbors=5, n_jobs=4)
+    low_precision = knn.KnnPredictor(reference.astype(np.float32), labels, [0, 1, 2], n_neighbors=5, dtype=np.float32)
+
+    np.testing.assert_array_equal(sharded.predict(queries), single.predict(queries))
+    assert np.mean(low_precision.predict(queries) == single.predict(queries)) > 0.99
+
+
+def test_search_raises_once_its_deadline_has_passed():
+    reference = np.random.default_rng(0).normal(size=(100, 4))
+
+    with pytest.raises(knn.DeadlineExceeded):
+        knn.kneighbors(reference[:10], reference, 3, deadline=0)
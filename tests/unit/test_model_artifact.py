@@ -0,0 +1,58 @@
+import json
+import os
+
+import numpy as np
+import pytest
+from sklearn.neighbors import KNeighborsClassifier
+
+import model_artifact
+
+FEATURE_COLUMNS = ['SepalLengthCm','SepalWidthCm','PetalLengthCm','PetalWidthCm']
+
+
+def dataset(seed=0):
+    rng = np.random.default_rng(seed)
+    features = rng.normal(size=(300, 4)).astype(np.float32)
+    labels = np.array(["Iris-setosa", "Iris-versicolor", "Iris-virginica"])[rng.integers(0, 3, 300)]
+    queries = rng.normal(size=(50, 4)).astype(np.float32)
+    return features, labels, queries
+
+
+@pytest.mark.parametrize("weights", ["uniform", "distance"])
+@pytest.mark.parametrize("metric", ["minkowski", "manhattan"])
+def test_artifact_predictions_match_sklearn(tmp_path, weights, metric):
+    features, labels, queries = dataset()
+    model = KNeighborsClassifier(n_neighbors=5, weights=weights, metric=metric).fit(features, labels)
+
+    model_artifact.export_knn(model, str(tmp_path), FEATURE_COLUMNS, features, labels)
+    artifact = model_artifact.load_artifact(str(tmp_path), verify=True)
+
+    assert isinstance(artifact.features, np.memmap)
+    np.testing.assert_array_equal(artifact.predict(queries), model.predict(queries))
+    np.testing.assert_allclose(artifact.predict_proba(queries), model.predict_proba(queries))
+
+
+def test_prebuilt_index_gives_the_same_neighbours(tmp_path):
+    features, labels, queries = dataset(1)
+    model_artifact.write_artifact(str(tmp_path), features, labels, 3, FEATURE_COLUMNS, index_type="kd_tree")
+
+    brute = model_artifact.load_artifact(str(tmp_path))
+    indexed = model_artifact.load_artifact(str(tmp_path), use_index=True)
+
+    assert indexed.index is not None
+    np.testing.assert_array_equal(indexed.kneighbors(queries)[1], brute.kneighbors(queries)[1])
+
+
+def test_manifest_records_format_and_checksums(tmp_path):
+    features, labels, _ = dataset()
+    model_artifact.write_artifact(str(tmp_path), features, labels, 3, FEATURE_COLUMNS)
+
+    manifest = json.load(open(os.path.join(str(tmp_path), "manifest.json")))
+    assert manifest["format_version"] == model_artifact.FORMAT_VERSION
+    assert manifest["metric"] == "euclidean"
+    assert manifest["classes"] == ["Iris-setosa", "Iris-versicolor", "Iris-virginica"]
+    assert set(manifest["files"]) == {"features.npy", "labels.npy"}
+
+    np.save(os.path.join(str(tmp_path), "labels.npy"), np.zeros(300, dtype=np.int32))
+    with pytest.raises(ValueError):
+        model_artifact.load_artifact(str(tmp_path), verify=True)
@@ -0,0 +1,56 @@
+import pytest
+
+import s3_io
+
+MiB = 1024 * 1024
+
+
+@pytest.fixture
+def client(s3_client, monkeypatch):
+    # multipart from 5 MiB, the smallest part S3 accepts
+    monkeypatch.setenv("S3_MULTIPART_THRESHOLD", str(5 * MiB))
+    monkeypatch.setenv("S3_MULTIPART_CHUNKSIZE", str(5 * MiB))
+    return s3_client
+
+
+def test_large_objects_round_trip_through_memory_in_parts(client):
+    body = bytes(range(256)) * (48 * 1024)
+
+    s3_io.write_bytes(client, "bucket", "large", body)
+
+    # a multipart upload leaves a "-<parts>" suffix on the ETag
+    assert client.head_object(Bucket="bucket", Key="large")["ETag"].endswith('-3"')
+    assert s3_io.read_bytes(client, "bucket", "large") == body
+
+
+def test_copy_is_server_side_and_exists_checks_keys(client):
+    s3_io.write_bytes(client, "bucket", "models/v1/model", b"model")
+
+    s3_io.copy(client, "bucket", "models/v1/model", "models/latest/model")
+
+    assert s3_io.read_bytes(client, "bucket", "models/latest/model") == b"model"
+    assert s3_io.exists(client, "bucket", "models/latest/model")
+    assert not s3_io.exists(client, "bucket", "models/latest/missing")
+    assert s3_io.read_many(client, "bucket", ["models/v1/model", "models/latest/model"]) == [b"model", b"model"]
+
+
+def test_client_is_shared_and_pool_follows_the_environment(client, monkeypatch):
+    monkeypatch.setattr(s3_io, "_clients", {})
+    monkeypatch.setenv("S3_MAX_POOL_CONNECTIONS", "64")
+
+    assert s3_io.client() is s3_io.client()
+    assert s3_io.client().meta.config.max_pool_connections == 64
+    assert s3_io.transfer_config().max_request_concurrency == 16
+
+
+def test_concurrent_reads_share_the_pool(monkeypatch):
+    monkeypatch.setenv("S3_MAX_POOL_CONNECTIONS", "8")
+    concurrency = []
+    monkeypatch.setattr(s3_io, "read_bytes", lambda s3, bucket, key, config=None: concurrency.append(config.max_request_concurrency) or key)
+
+    assert s3_io.read_many(None, "bucket", ["a", "b", "c"]) == ["a", "b", "c"]
+    assert set(concurrency) == {2}
+
+    concurrency.clear()
+    s3_io.read_many(None, "bucket", [str(key) for key in range(20)])
+    assert set(concurrency) == {1}
@@ -0,0 +1,85 @@
+import time
+
+import numpy as np
+from sklearn.model_selection import StratifiedKFold, cross_val_score
+from sklearn.neighbors import KNeighborsClassifier
+
+import search
+
+
+def dataset(seed=0):
+    rng = np.random.default_rng(seed)
+    centers = np.array([[0, 0, 0, 0], [2, 2, 0, 0], [0, 2, 2, 2]])
+    y = rng.integers(0, 3, 600)
+    X = centers[y] + rng.normal(scale=1.0, size=(600, 4))
+    return X, y
+
+
+def test_cross_validated_scores_match_sklearn():
+    X, y = dataset()
+    grid = search.parse_grid({"n_neighbors": [1, 5, 9], "weights": ["uniform", "distance"], "metric": ["euclidean", "manhattan"]})
+
+    result = search.cross_validate(X, y, grid, folds=4, n_jobs=2)
+
+    assert len(result["leaderboard"]) == 12
+    assert result["leaderboard"][0]["rank"] == 1
+    cv = StratifiedKFold(n_splits=4, shuffle=True, random_state=0)
+    for entry in result["leaderboard"]:
+        expected = cross_val_score(KNeighborsClassifier(**entry["params"]), X, y, cv=cv)
+        np.testing.assert_allclose(entry["fold_accuracy"], expected)
+
+
+def test_expired_deadline_skips_every_configuration():
+    X, y = dataset()
+    grid = search.parse_grid({"n_neighbors": [3], "weights": ["uniform"], "metric": ["euclidean"]})
+
+    result = search.cross_validate(X, y, grid, folds=3, deadline=time.monotonic() - 1)
+
+    assert result["leaderboard"] == []
+    assert result["skipped"] == 1
+
+
+def test_stratified_sample_keeps_class_balance():
+    y = np.repeat([0, 1, 2], [600, 300, 100])
+
+    sample = search.stratified_sample(y, 100)
+
+    assert np.bincount(y[sample]).tolist() == [60, 30, 10]
+
+
+class SteppingClock:
+    # every perf_counter() call is one second after the previous one
+    def __init__(self):
+        self.now = 0.0
+
+    def perf_counter(self):
+        self.now += 1.0
+        return self.now
+
+
+def test_sample_is_sized_to_the_time_budget(monkeypatch):
+    X, _ = dataset()
+    grid = search.parse_grid({"metric": ["euclidean", "manhattan"]})
+    monkeypatch.setattr(search, "time", SteppingClock())
+
+    # 1s per metric on the 600 row probe, 2 metrics on 2 threads, half of the budget:
+    # n^2 * 4/5 * 2/600^2 = 4 * 0.5 * 2
+    assert search.budget_sample_rows(X, grid, folds=5, seconds=4, n_jobs=2) == 948
+
+
+def test_running_task_stops_at_the_deadline(monkeypatch):
+    X, y = dataset()
+    grid = search.parse_grid({"n_neighbors": [3], "weights": ["uniform"], "metric": ["euclidean"]})
+    deadline = time.monotonic() + 60
+
+    class PastDeadline:
+        @staticmethod
+        def monotonic():
+            return deadline + 1
+
+    # the tasks start before the deadline, the neighbour search then finds it passed
+    monkeypatch.setattr(search.knn, "time", PastDeadline)
+    result = search.cross_validate(X, y, grid, folds=3, deadline=deadline)
+
+    assert result["leaderboard"] == []
+    assert result["skipped"] == 1
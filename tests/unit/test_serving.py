@@ -0,0 +1,220 @@
+import asyncio
+import json
+import threading
+
+import numpy as np
+from sklearn.neighbors import KNeighborsClassifier
+
+import serving
+
+FEATURES = [[5.1, 3.5, 1.4, 0.2], [7.0, 3.2, 4.7, 1.4], [6.3, 3.3, 6.0, 2.5]]
+SPECIES = ["Iris-setosa", "Iris-versicolor", "Iris-virginica"]
+
+
+class CountingModel:
+
+    def __init__(self, release=None):
+        self.model = KNeighborsClassifier(n_neighbors=1).fit(np.array(FEATURES), SPECIES)
+        self.classes_ = self.model.classes_
+        self.batch_sizes = []
+        self.release = release
+
+    def predict_proba(self, matrix):
+        if self.release is not None:
+            self.release.wait(5)
+        self.batch_sizes.append(len(matrix))
+        return self.model.predict_proba(matrix)
+
+
+def run(coroutine):
+    return asyncio.get_event_loop_policy().new_event_loop().run_until_complete(coroutine)
+
+
+def test_concurrent_requests_are_scored_in_micro_batches_and_cached():
+    model = CountingModel()
+
+    async def scenario():
+        batcher = serving.MicroBatcher(load_model=lambda: model, max_batch_size=4, max_wait_ms=50)
+        await batcher.start()
+        records = [{"id": row, "features": FEATURES[row % 3]} for row in range(6)]
+        results = await asyncio.gather(*[batcher.predict(record) for record in records])
+        again = await batcher.predict(FEATURES[2])
+        await batcher.stop()
+        return batcher, results, again
+
+    batcher, results, again = run(scenario())
+
+    # the second batch repeats rows of the first and is answered from the cache
+    assert model.batch_sizes == [4]
+    assert [result["prediction"] for result in results] == SPECIES * 2
+    assert [result["id"] for result in results] == list(range(6))
+    assert results[0]["probabilities"] == {"Iris-setosa": 1.0, "Iris-versicolor": 0.0, "Iris-virginica": 0.0}
+    # so is a later single request, without another predict_proba call
+    assert again["prediction"] == "Iris-virginica"
+    assert len(model.batch_sizes) == 1
+    stats = batcher.stats()
+    assert stats["cache"]["hits"] == 3
+    assert stats["mean_batch_size"] == 4
+    assert stats["latency"]["count"] == 7
+
+
+def test_cached_results_are_dropped_when_the_model_changes():
+    models = [CountingModel()]
+    relabelled = CountingModel()
+    relabelled.model = KNeighborsClassifier(n_neighbors=1).fit(np.array(FEATURES), ["a", "b", "c"])
+    relabelled.classes_ = relabelled.model.classes_
+
+    async def scenario():
+        batcher = serving.MicroBatcher(load_model=lambda: models[0], max_wait_ms=0)
+        await batcher.start()
+        before = await batcher.predict(FEATURES[0])
+        models[0] = relabelled
+        after = await batcher.predict(FEATURES[0])
+        await batcher.stop()
+        return batcher, before, after
+
+    batcher, before, after = run(scenario())
+
+    assert before["prediction"] == "Iris-setosa"
+    assert after["prediction"] == "a"
+    assert relabelled.batch_sizes == [1]
+    assert batcher.stats()["cache"]["hits"] == 0
+
+
+def test_a_blocking_model_load_does_not_stall_the_event_loop():
+    model = CountingModel()
+    loading = threading.Event()
+    release = threading.Event()
+
+    def load_model():
+        # a refresh of the model, e.g. an S3 download once its TTL has expired
+        if model.batch_sizes:
+            loading.set()
+            release.wait(5)
+        return model
+
+    async def scenario():
+        batcher = serving.MicroBatcher(load_model=load_model, max_wait_ms=0)
+        await batcher.start()
+        await batcher.predict(FEATURES[0])
+        # a cache hit waits for the worker's model check, the loop keeps serving
+        pending = asyncio.ensure_future(batcher.predict(FEATURES[0]))
+        while not loading.is_set():
+            await asyncio.sleep(0.01)
+        health = await asyncio.wait_for(serving.dispatch(batcher, "GET", "/health", b""), 1)
+        queued = asyncio.ensure_future(batcher.predict(FEATURES[1]))
+        await asyncio.sleep(0.05)
+        depth = batcher.stats()["queue_depth"]
+        release.set()
+        results = await asyncio.gather(pending, queued)
+        await batcher.stop()
+        return health, depth, results
+
+    (status, _), depth, results = run(scenario())
+
+    assert status == 200
+    assert depth == 1
+    assert [result["prediction"] for result in results] == ["Iris-setosa", "Iris-versicolor"]
+
+
+def test_full_queue_rejects_requests():
+    release = threading.Event()
+    model = CountingModel(release)
+
+    async def scenario():
+        batcher = serving.MicroBatcher(load_model=lambda: model, max_batch_size=1, max_wait_ms=0, max_queue=1)
+        await batcher.start()
+        scoring = asyncio.ensure_future(batcher.predict(FEATURES[0]))
+        await asyncio.sleep(0.05)
+        queued = asyncio.ensure_future(batcher.predict(FEATURES[1]))
+        await asyncio.sleep(0)
+        status, payload = await serving.dispatch(batcher, "POST", "/predict", json.dumps(FEATURES[2]).encode())
+        release.set()
+        await asyncio.gather(scoring, queued)
+        await batcher.stop()
+        return batcher, status, payload
+
+    batcher, status, payload = run(scenario())
+
+    assert status == 503
+    assert "queue is full" in payload["error"]
+    assert batcher.rejected == 1
+
+
+def test_cache_evicts_least_recently_used():
+    cache = serving.PredictionCache(max_entries=2)
+    cache.put(b"a", 1)
+    cache.put(b"b", 2)
+    cache.get(b"a")
+    cache.put(b"c", 3)
+
+    assert cache.get(b"b") is None
+    assert (cache.get(b"a"), cache.get(b"c")) == (1, 3)
+    assert cache.evictions == 1
+
+
+def test_histogram_percentiles_are_within_a_bucket():
+    histogram = serving.LatencyHistogram()
+    for ms in range(1, 101):
+        histogram.record(float(ms))
+
+    summary = histogram.summary()
+    assert 50 <= summary["p50_ms"] <= 50 * 1.05
+    assert 95 <= summary["p95_ms"] <= 95 * 1.05
+    assert 99 <= summary["p99_ms"] <= 100
+    assert summary["max_ms"] == 100
+
+
+def test_http_server_serves_predictions_and_stats():
+    model = CountingModel()
+
+    async def request(port, method, path, body=b""):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write((method + " " + path + " HTTP/1.1\r\nContent-Length: " + str(len(body)) + "\r\nConnection: close\r\n\r\n").encode() + body)
+        await writer.drain()
+        response = await reader.read()
+        writer.close()
+        head, _, payload = response.partition(b"\r\n\r\n")
+        return int(head.split()[1]), json.loads(payload)
+
+    async def scenario():
+        batcher = serving.MicroBatcher(load_model=lambda: model)
+        server = await serving.start_server(batcher, port=0)
+        port = server.sockets[0].getsockname()[1]
+        responses = [
+            await request(port, "POST", "/predict", json.dumps({"records": FEATURES}).encode()),
+            await request(port, "POST", "/predict", b"{not json"),
+            await request(port, "GET", "/stats")
+        ]
+        server.close()
+        await server.wait_closed()
+        await batcher.stop()
+        return responses
+
+    (status, payload), (bad_status, _), (stats_status, stats) = run(scenario())
+
+    assert status == 200
+    assert [result["prediction"] for result in payload["results"]] == SPECIES
+    assert bad_status == 400
+    assert stats_status == 200 and stats["requests"] == 3
+
+
+def test_function_url_events_are_dispatched(monkeypatch, capsys):
+    model = CountingModel()
+    monkeypatch.setattr(serving.inference, "load_model", lambda: model)
+    monkeypatch.setattr(serving, "_batcher", None)
+    monkeypatch.setattr(serving, "_loop", None)
+
+    response = serving.url_handler({
+        "rawPath": "/predict",
+        "requestContext": {"http": {"method": "POST"}},
+        "body": json.dumps({"id": "a", "SepalLengthCm": 7.0, "SepalWidthCm": 3.2, "PetalLengthCm": 4.7, "PetalWidthCm": 1.4}),
+        "isBase64Encoded": False
+    }, None)
+    serving._loop.run_until_complete(serving._batcher.stop())
+    serving._loop.close()
+
+    assert response["statusCode"] == 200
+    assert json.loads(response["body"])["prediction"] == "Iris-versicolor"
+    assert json.loads(response["body"])["id"] == "a"
+    assert '"RequestTime"' in capsys.readouterr().out
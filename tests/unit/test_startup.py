@@ -0,0 +1,51 @@
+import os
+import subprocess
+import sys
+
+import startup
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        self.now += 1.0
+        return self.now
+
+
+def test_profiler_reports_imports_phases_and_first_prediction_once():
+    profiler = startup.StartupProfiler(clock=FakeClock())
+    profiler.import_module("json")
+    profiler.import_module("colorsys")
+    profiler.end_init()
+    with profiler.phase("load_model"):
+        pass
+    with profiler.phase("load_model"):
+        pass
+
+    assert profiler.take_report() is None
+    assert profiler.first_prediction()
+    assert not profiler.first_prediction()
+    report = profiler.take_report()
+    assert profiler.take_report() is None
+
+    # json was imported already, only colorsys is timed
+    assert list(report["imports"]) == ["colorsys"]
+    assert report["imports"]["colorsys"]["seconds"] == 1.0
+    assert report["init_seconds"] == 3.0
+    assert report["phases"] == {"load_model": 1.0}
+    assert report["first_prediction_seconds"] == 6.0
+
+
+def test_inference_entry_point_does_not_import_pandas_or_sklearn():
+    path = os.pathsep.join(os.path.join(ROOT, source_dir) for source_dir in ["inference_lambda", "common"])
+    code = "import sys, inference; print(sorted(m for m in ['pandas', 'sklearn', 'streaming'] if m in sys.modules))"
+    env = dict(os.environ, PYTHONPATH=path, AWS_DEFAULT_REGION="us-east-1")
+
+    output = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True, check=True).stdout
+
+    assert output.strip() == "[]"
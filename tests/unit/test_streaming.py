@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+from sklearn.neighbors import KNeighborsClassifier
+
+import streaming
+
+FEATURE_COLUMNS = ['SepalLengthCm','SepalWidthCm','PetalLengthCm','PetalWidthCm']
+
+
+def iris_like_csv(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    features = rng.uniform(0, 8, size=(rows, 4)).round(1)
+    lines = ["Id,SepalLengthCm,SepalWidthCm,PetalLengthCm,PetalWidthCm,Species"]
+    for row, values in enumerate(features):
+        lines.append(",".join([str(row + 1)] + [str(v) for v in values] + ["Iris-setosa"]))
+    return ("\n".join(lines) + "\n").encode(), features
+
+
+@pytest.mark.parametrize("chunk_bytes", [7, 64, 1 << 20])
+def test_consecutive_ranges_yield_every_line_once(s3_client, chunk_bytes):
+    body = b"".join(b"line-" + str(i).encode() * (i % 5 + 1) + b"\n" for i in range(200))
+    s3_client.put_object(Bucket="bucket", Key="lines.txt", Body=body)
+
+    boundaries = [0, 1, 13, 250, 251, 900, len(body)]
+    lines = []
+    for start, end in zip(boundaries, boundaries[1:]):
+        lines.extend(streaming.iter_lines(s3_client, "bucket", "lines.txt", start=start, end=end, chunk_bytes=chunk_bytes))
+
+    assert lines == body.split(b"\n")[:-1]
+
+
+def test_stream_scores_csv_in_blocks(s3_client):
+    body, features = iris_like_csv(1000)
+    s3_client.put_object(Bucket="bucket", Key="input.csv", Body=body)
+    model = KNeighborsClassifier(n_neighbors=1).fit(features, np.where(features[:, 0] > 4, "big", "small"))
+
+    response = streaming.score_stream(
+        s3_client, model, "bucket", "input.csv", "bucket", "output.csv", FEATURE_COLUMNS,
+        block_rows=128, chunk_bytes=1024
+    )
+
+    output = s3_client.get_object(Bucket="bucket", Key="output.csv")["Body"].read().decode().splitlines()
+    assert response["rows"] == 1000
+    assert response["parts"] == 0
+    assert output[0] == "1," + ("big" if features[0, 0] > 4 else "small")
+    assert [line.split(",")[0] for line in output] == [str(i) for i in range(1, 1001)]
+
+
+def test_large_output_is_uploaded_in_parts(s3_client):
+    payload = b"x" * (streaming.MIN_PART_BYTES + 10)
+
+    with streaming.MultipartWriter(s3_client, "bucket", "big.bin", part_bytes=streaming.MIN_PART_BYTES) as writer:
+        writer.write(payload)
+        writer.write(b"tail")
+
+    assert len(writer.parts) == 2
+    assert s3_client.get_object(Bucket="bucket", Key="big.bin")["Body"].read() == payload + b"tail"
+
+
+def test_failed_stream_aborts_multipart_upload(s3_client):
+    with pytest.raises(RuntimeError):
+        with streaming.MultipartWriter(s3_client, "bucket", "broken.bin", part_bytes=streaming.MIN_PART_BYTES) as writer:
+            writer.write(b"x" * streaming.MIN_PART_BYTES)
+            raise RuntimeError("scoring failed")
+
+    assert "Uploads" not in s3_client.list_multipart_uploads(Bucket="bucket")
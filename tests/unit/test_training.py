@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+import training
+
+BUCKET = "cdk-ml-pipeline-iris"
+
+
+@pytest.fixture
+def bucket():
+    return BUCKET
+
+
+@pytest.fixture
+def s3(s3):
+    rng = np.random.default_rng(0)
+    species = ["Iris-setosa", "Iris-versicolor", "Iris-virginica"]
+    lines = ["Id,SepalLengthCm,SepalWidthCm,PetalLengthCm,PetalWidthCm,Species"]
+    for row in range(150):
+        values = rng.uniform(0, 8, 4).round(1)
+        lines.append(",".join([str(row + 1)] + [str(v) for v in values] + [species[row % 3]]))
+    s3.Bucket(BUCKET).put_object(Key="data/Iris.csv", Body="\n".join(lines).encode())
+    return s3
+
+
+def version_keys(s3):
+    return sorted(
+        item.key for item in s3.Bucket(BUCKET).objects.filter(Prefix="models/")
+        if item.key.endswith("/version.json") and "/latest/" not in item.key
+    )
+
+
+def test_retraining_unchanged_data_yields_the_same_content_hash(s3):
+    first = training.handler({}, None)
+    second = training.handler({}, None)
+
+    assert first["model_hash"] == second["model_hash"]
+    assert first["model_path"] == "models/"+first["model_hash"]+"/finalized_model.sav"
+    assert version_keys(s3) == ["models/"+first["model_hash"]+"/version.json"]
+    assert first["changed"] is True
+
+
+def test_model_in_use_is_reported_unchanged(s3):
+    model_hash = training.handler({}, None)["model_hash"]
+    s3.Bucket(BUCKET).put_object(Key=training.IN_USE_HASH_KEY, Body=model_hash.encode())
+
+    result = training.handler({}, None)
+
+    assert result["in_use_hash"] == model_hash
+    assert result["changed"] is False
+    assert training.handler({"random_state": 1}, None)["changed"] is True
+
+
+def test_latest_alias_is_a_copy_of_the_version(s3):
+    result = training.handler({}, None)
+    prefix = "models/"+result["model_hash"]+"/"
+
+    versioned = {item.key[len(prefix):]: item.e_tag for item in s3.Bucket(BUCKET).objects.filter(Prefix=prefix)}
+    latest = {item.key[len("models/latest/"):]: item.e_tag for item in s3.Bucket(BUCKET).objects.filter(Prefix="models/latest/")}
+
+    assert "finalized_model.sav" in versioned and "artifact/manifest.json" in versioned
+    assert latest == versioned
@@ -0,0 +1,103 @@
+import io
+
+import boto3
+from botocore.response import StreamingBody
+from botocore.stub import Stubber
+
+import warm_cache
+from warm_cache import WarmCache
+
+
+def body(payload):
+    return StreamingBody(io.BytesIO(payload), len(payload))
+
+
+def stubbed_cache(ttl_seconds=0.0):
+    cache = WarmCache(ttl_seconds=ttl_seconds)
+    cache._resources["s3"] = boto3.resource("s3", region_name="us-east-1")
+    return cache, Stubber(cache._resources["s3"].meta.client)
+
+
+def test_unchanged_object_is_revalidated_not_reloaded():
+    cache, stubber = stubbed_cache()
+    loads = []
+
+    def loader(payload):
+        loads.append(payload)
+        return payload.decode()
+
+    stubber.add_response("get_object", {"Body": body(b"a,b"), "ETag": '"v1"'},
+        {"Bucket": "bucket", "Key": "data.csv"})
+    stubber.add_client_error("get_object", service_error_code="304", http_status_code=304,
+        expected_params={"Bucket": "bucket", "Key": "data.csv", "IfNoneMatch": '"v1"'})
+
+    with stubber:
+        assert cache.get_s3_object("bucket", "data.csv", loader) == "a,b"
+        assert cache.get_s3_object("bucket", "data.csv", loader) == "a,b"
+
+    assert len(loads) == 1
+    assert cache.stats()["misses"] == 1
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["revalidations"] == 1
+
+
+def test_fresh_entry_skips_s3_entirely():
+    cache, stubber = stubbed_cache(ttl_seconds=300)
+    stubber.add_response("get_object", {"Body": body(b"x"), "ETag": '"v1"'})
+
+    with stubber:
+        cache.get_s3_object("bucket", "key", bytes.decode)
+        cache.get_s3_object("bucket", "key", bytes.decode)
+
+    stubber.assert_no_pending_responses()
+    assert cache.stats()["hits"] == 1
+
+
+def test_changed_object_is_reloaded():
+    cache, stubber = stubbed_cache()
+    stubber.add_response("get_object", {"Body": body(b"old"), "ETag": '"v1"'})
+    stubber.add_response("get_object", {"Body": body(b"new"), "ETag": '"v2"'},
+        {"Bucket": "bucket", "Key": "key", "IfNoneMatch": '"v1"'})
+
+    with stubber:
+        assert cache.get_s3_object("bucket", "key", bytes.decode) == "old"
+        assert cache.get_s3_object("bucket", "key", bytes.decode) == "new"
+
+    assert cache.stats()["misses"] == 2
+
+
+def test_least_recently_used_entry_is_evicted_over_budget(tmp_path):
+    cache = WarmCache(max_bytes=10)
+    for name in ["a", "b", "c"]:
+        (tmp_path / name).write_bytes(b"12345")
+
+    cache.get_file(str(tmp_path / "a"), lambda path: path)
+    cache.get_file(str(tmp_path / "b"), lambda path: path)
+    cache.get_file(str(tmp_path / "a"), lambda path: path)
+    cache.get_file(str(tmp_path / "c"), lambda path: path)
+
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["entries"] == 2
+    cache.get_file(str(tmp_path / "a"), lambda path: path)
+    assert cache.stats()["hits"] == 2
+
+
+def test_rss_pressure_evicts_only_the_excess_and_keeps_the_new_entry(tmp_path, monkeypatch):
+    cache = WarmCache(rss_limit_bytes=1000)
+    for name in ["a", "b", "c", "d"]:
+        (tmp_path / name).write_bytes(b"12345")
+    monkeypatch.setattr(warm_cache, "_current_rss_bytes", lambda: 0)
+    for name in ["a", "b", "c"]:
+        cache.get_file(str(tmp_path / name), lambda path: path)
+
+    # 6 bytes over the limit, two 5 byte entries cover it
+    monkeypatch.setattr(warm_cache, "_current_rss_bytes", lambda: 1006)
+    cache.get_file(str(tmp_path / "d"), lambda path: path)
+
+    assert cache.stats()["evictions"] == 2
+    assert [key[1][-1] for key in cache._entries] == ["c", "d"]
+
+    # however far over the limit, the entry just loaded stays cached
+    monkeypatch.setattr(warm_cache, "_current_rss_bytes", lambda: 10 ** 12)
+    cache.get_file(str(tmp_path / "a"), lambda path: path)
+    assert [key[1][-1] for key in cache._entries] == ["a"]
@@ -0,0 +1,102 @@
+import io
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from botocore.exceptions import ClientError
+
+import model_artifact
+import s3_io
+
+# Incremental training. KNN is a lazy learner, so a new model version is the
+# previous version's reference arrays with the rows of the new data partitions
+# appended. New partitions are found by listing the partition prefix after the
+# watermark, the last partition key already merged, so partition keys must sort
+# in arrival order (e.g. data/incremental/2022-09-01T10-00.csv).
+
+DEFAULT_PREFIX = "data/incremental/"
+WATERMARK_KEY = "models/watermark.json"
+
+
+def read_watermark(client, bucket, key=WATERMARK_KEY):
+    try:
+        return json.loads(client.get_object(Bucket=bucket, Key=key)["Body"].read())
+    except ClientError as error:
+        if error.response["Error"]["Code"] not in ["NoSuchKey", "404"]:
+            raise
+        return {"last_key": None, "partitions": 0, "rows": 0, "model_path": None}
+
+
+def parent_prefix(watermark):
+    """Version prefix of the model the watermark was last written with.
+
+    Incremental runs advance the watermark with their merged version, full and
+    search runs reset it to theirs, so every partition before the watermark is
+    part of the parent. Without a watermark it is latest/.
+    """
+    if watermark.get("model_hash"):
+        return "models/"+watermark["model_hash"]+"/"
+    return "models/latest/"
+
+
+def write_watermark(client, bucket, watermark, key=WATERMARK_KEY):
+    client.put_object(Bucket=bucket, Key=key, Body=json.dumps(watermark, indent=2).encode())
+
+
+def reset_watermark(client, bucket, model_path, model_hash, key=WATERMARK_KEY):
+    """Start over from a model trained on the full data, every partition gets merged onto it again."""
+    write_watermark(client, bucket, {
+        "last_key": None,
+        "partitions": 0,
+        "rows": 0,
+        "model_path": model_path,
+        "model_hash": model_hash
+    }, key)
+
+
+def list_new_partitions(client, bucket, prefix, last_key=None):
+    """Keys under prefix sorting after last_key, S3 lists keys in lexicographic order."""
+    kwargs = {"Bucket": bucket, "Prefix": prefix}
+    if last_key:
+        kwargs["StartAfter"] = last_key
+    keys = []
+    for page in client.get_paginator("list_objects_v2").paginate(**kwargs):
+        keys.extend(item["Key"] for item in page.get("Contents", []) if not item["Key"].endswith("/"))
+    return keys
+
+
+def partition_etags(client, bucket, keys):
+    return {key: client.head_object(Bucket=bucket, Key=key)["ETag"] for key in keys}
+
+
+def read_partitions(client, bucket, keys, feature_columns, label_column="Species"):
+    # partitions are read concurrently, straight into memory
+    frames = [pd.read_csv(io.BytesIO(body)) for body in s3_io.read_many(client, bucket, keys)]
+    frame = pd.concat(frames, ignore_index=True)
+    return frame[feature_columns].to_numpy(dtype=np.float64), frame[label_column].to_numpy()
+
+
+def download_artifact(client, bucket, prefix, directory):
+    """Download the artifact under prefix into directory, None if there is none."""
+    os.makedirs(directory, exist_ok=True)
+    try:
+        s3_io.download_file(client, bucket, prefix+model_artifact.MANIFEST_FILE, os.path.join(directory, model_artifact.MANIFEST_FILE))
+    except ClientError as error:
+        if error.response["Error"]["Code"] not in ["NoSuchKey", "404"]:
+            raise
+        return None
+    manifest = model_artifact.read_manifest(directory)
+    # the arrays are memory mapped from disk, large ones arrive as parallel ranged GETs
+    for name in manifest["files"]:
+        s3_io.download_file(client, bucket, prefix+name, os.path.join(directory, name))
+    model_artifact.verify_artifact(directory, manifest)
+    return manifest
+
+
+def append_rows(artifact, features, labels):
+    """Reference features and string labels of artifact with the new rows appended."""
+    previous_labels = artifact.classes_[np.asarray(artifact.labels)]
+    combined_features = np.concatenate([np.asarray(artifact.features, dtype=np.float64), features])
+    combined_labels = np.concatenate([previous_labels.astype(object), np.asarray(labels, dtype=object)])
+    return combined_features, combined_labels
@@ -0,0 +1,141 @@
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from sklearn.model_selection import StratifiedKFold
+
+import knn
+
+# Cross validated grid search over KNN hyperparameters. Every (metric, fold) pair
+# is one task: it finds the max(n_neighbors) nearest training rows of every
+# validation row once, and every (n_neighbors, weights) combination is then scored
+# from the first n_neighbors columns of that one neighbour search. Tasks run on a
+# thread pool sized to the Lambda vCPUs, the neighbour search is BLAS bound and
+# releases the GIL. The search grows with the square of the row count, so large
+# data sets are searched on a sample sized to the time budget and a task that
+# runs past the deadline gives up midway.
+
+DEFAULT_GRID = {
+    "n_neighbors": [1, 3, 5, 7, 9, 11, 15],
+    "weights": ["uniform", "distance"],
+    "metric": ["euclidean", "manhattan"]
+}
+# Share of the time budget the sample is sized for, the estimate below assumes
+# perfect parallelism and cache friendly blocks
+SAMPLE_BUDGET_FRACTION = 0.5
+PROBE_ROWS = 2000
+
+
+def parse_grid(spec):
+    grid = {name: list(spec.get(name, values)) for name, values in DEFAULT_GRID.items()}
+    for metric in grid["metric"]:
+        if metric not in knn.METRICS:
+            raise ValueError("unsupported metric "+str(metric)+", expected one of "+str(knn.METRICS))
+    for weights in grid["weights"]:
+        if weights not in ["uniform", "distance"]:
+            raise ValueError("unsupported weights "+str(weights))
+    return grid
+
+
+def stratified_sample(y, max_rows, seed=0):
+    """Indices of a class stratified random sample of at most max_rows rows."""
+    if max_rows is None or len(y) <= max_rows:
+        return np.arange(len(y))
+    rng = np.random.default_rng(seed)
+    selected = []
+    for label in np.unique(y):
+        members = np.flatnonzero(y == label)
+        take = max(1, int(round(len(members) * max_rows / len(y))))
+        selected.append(rng.choice(members, size=min(take, len(members)), replace=False))
+    return np.sort(np.concatenate(selected))
+
+
+def budget_sample_rows(X, grid, folds, seconds, n_jobs=None, probe_rows=PROBE_ROWS, seed=0):
+    """Rows the grid search is expected to get through in seconds.
+
+    A task searches the (folds - 1) / folds training rows of its fold for each of
+    the n / folds validation rows, so a metric costs about n^2 (folds - 1) / folds
+    distance evaluations. The cost of one is measured on a probe of the data.
+    """
+    X = np.ascontiguousarray(X, dtype=np.float64)
+    rng = np.random.default_rng(seed)
+    probe = X[rng.choice(len(X), size=min(probe_rows, len(X)), replace=False)]
+    seconds_per_pair = 0.0
+    for metric in grid["metric"]:
+        start = time.perf_counter()
+        knn.kneighbors(probe, probe, max(grid["n_neighbors"]), metric=metric)
+        seconds_per_pair += (time.perf_counter() - start) / len(probe) ** 2
+    parallel = min(n_jobs or knn.default_n_jobs(), len(grid["metric"]) * folds)
+    budget = max(seconds, 0) * SAMPLE_BUDGET_FRACTION * parallel
+    return max(folds * 2, int(math.sqrt(budget * folds / ((folds - 1) * seconds_per_pair))))
+
+
+def _evaluate(X, y, n_classes, train, test, metric, grid, deadline):
+    if deadline is not None and time.monotonic() > deadline:
+        return None
+    start = time.perf_counter()
+    try:
+        distances, indices = knn.kneighbors(X[test], X[train], max(grid["n_neighbors"]), metric=metric,
+            deadline=deadline)
+    except knn.DeadlineExceeded:
+        return None
+    search_seconds = time.perf_counter() - start
+
+    neighbor_labels = y[train][indices]
+    scores = {}
+    for k in grid["n_neighbors"]:
+        for weights in grid["weights"]:
+            start = time.perf_counter()
+            proba = knn.vote(neighbor_labels[:, :k], distances[:, :k], n_classes, weights)
+            accuracy = float(np.mean(np.argmax(proba, axis=1) == y[test]))
+            scores[(k, weights)] = (accuracy, time.perf_counter() - start)
+    return search_seconds, scores
+
+
+def cross_validate(X, y, grid, folds=5, n_jobs=None, deadline=None, seed=0):
+    """Score every grid combination with stratified k-fold CV, returning the leaderboard.
+
+    y must hold class indices. Tasks that would start after deadline (a
+    time.monotonic() value) are skipped and running ones stop at it, combinations
+    missing any fold are left out of the leaderboard and counted in the returned
+    "skipped" total.
+    """
+    X = np.ascontiguousarray(X, dtype=np.float64)
+    n_classes = int(y.max()) + 1
+    splits = list(StratifiedKFold(n_splits=folds, shuffle=True, random_state=seed).split(X, y))
+    tasks = [(metric, fold) for metric in grid["metric"] for fold in range(folds)]
+
+    def run(task):
+        metric, fold = task
+        train, test = splits[fold]
+        return _evaluate(X, y, n_classes, train, test, metric, grid, deadline)
+
+    with ThreadPoolExecutor(max_workers=n_jobs or knn.default_n_jobs()) as executor:
+        results = dict(zip(tasks, executor.map(run, tasks)))
+
+    leaderboard = []
+    skipped = 0
+    for metric in grid["metric"]:
+        fold_results = [results[(metric, fold)] for fold in range(folds)]
+        for k in grid["n_neighbors"]:
+            for weights in grid["weights"]:
+                if any(result is None for result in fold_results):
+                    skipped += 1
+                    continue
+                accuracies = [result[1][(k, weights)][0] for result in fold_results]
+                leaderboard.append({
+                    "params": {"n_neighbors": k, "weights": weights, "metric": metric},
+                    "mean_accuracy": float(np.mean(accuracies)),
+                    "std_accuracy": float(np.std(accuracies)),
+                    "fold_accuracy": accuracies,
+                    # the neighbour search is shared by every k and weights of a metric
+                    "mean_fit_seconds": float(np.mean([result[0] for result in fold_results])),
+                    "mean_score_seconds": float(np.mean([result[1][(k, weights)][1] for result in fold_results]))
+                })
+
+    # best mean first, then the most stable, then the smallest k
+    leaderboard.sort(key=lambda entry: (-entry["mean_accuracy"], entry["std_accuracy"], entry["params"]["n_neighbors"]))
+    for rank, entry in enumerate(leaderboard, start=1):
+        entry["rank"] = rank
+    return {"leaderboard": leaderboard, "skipped": skipped, "folds": folds, "rows": int(X.shape[0])}
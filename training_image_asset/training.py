@@ -1,22 +1,297 @@
 import numpy as np
 import pandas as pd
-import boto3
 import sklearn
 from sklearn.model_selection import train_test_split
 from sklearn.neighbors import KNeighborsClassifier
-from sklearn import metrics
+from sklearn.metrics import accuracy_score
+import hashlib
+import io
+import json
+import os
 import pickle
+import shutil
+import time
 import datetime
+from botocore.exceptions import ClientError
+
+import incremental
+import instrumentation
+import model_artifact
+import s3_io
+import search
+
+FEATURE_COLUMNS = ['SepalLengthCm','SepalWidthCm','PetalLengthCm','PetalWidthCm']
+# Time kept back from the Lambda timeout to refit the best model and upload it
+SEARCH_RESERVE_SECONDS = 120
+VERSION_FILE = "version.json"
+IN_USE_HASH_KEY = "models/in-use/model_hash"
+
+metrics = instrumentation.Metrics.from_environment()
+
+
+def model_version_hash(model_bytes, manifest, data_fingerprint):
+    # Identifies a model by what it is, the serialized estimator, the artifact
+    # contents and the data it was trained on, and not by when it was trained
+    version = {
+        "model": hashlib.sha256(model_bytes).hexdigest(),
+        "artifact": manifest["files"],
+        "params": {name: manifest[name] for name in ["n_neighbors", "weights", "metric", "dtype", "classes"]},
+        "data": data_fingerprint
+    }
+    return hashlib.sha256(json.dumps(version, sort_keys=True).encode()).hexdigest()
+
+
+def read_in_use_hash(s3, bucket):
+    # Written by the retrain-pipeline state machine once a model is deployed
+    try:
+        return s3.Object(bucket, IN_USE_HASH_KEY).get()["Body"].read().decode().strip()
+    except ClientError as error:
+        if error.response["Error"]["Code"] not in ["NoSuchKey", "404"]:
+            raise
+        return ""
+
+
+def read_version(s3, bucket, prefix):
+    # the version.json under a version or the latest/ prefix, None when there is none
+    try:
+        return json.loads(s3.Object(bucket, prefix+VERSION_FILE).get()["Body"].read())
+    except ClientError as error:
+        if error.response["Error"]["Code"] not in ["NoSuchKey", "404"]:
+            raise
+        return None
+
+
+def upload_model(s3, bucket, model, train_X, train_y, event, data_fingerprint, extra_files=None, artifact_extra=None,
+        on_version=None):
+    # on_version(path, model_hash) runs once the version is complete and before
+    # latest/ is pointed at it
+    filename='finalized_model.sav'
+    client = s3.meta.client
+    with metrics.timer("SerializeTime"):
+        model_bytes = pickle.dumps(model)
+
+        # Also export the memory mappable artifact next to the pickle, /tmp survives
+        # between warm invocations so start from an empty directory
+        artifact_dir='/tmp/artifact'
+        shutil.rmtree(artifact_dir, ignore_errors=True)
+        manifest = model_artifact.export_knn(model, artifact_dir, FEATURE_COLUMNS, train_X, train_y,
+            index_type=event.get("index_type"), extra=artifact_extra)
+
+    model_hash = model_version_hash(model_bytes, manifest, data_fingerprint)
+    prefix="models/"+model_hash+"/"
+    latest_prefix="models/"+"latest/"
+
+    files = {}
+    for artifact_file in os.listdir(artifact_dir):
+        files["artifact/"+artifact_file] = os.path.join(artifact_dir, artifact_file)
+
+    version = {
+        "model_hash": model_hash,
+        "data_fingerprint": data_fingerprint,
+        "created_at": datetime.datetime.now().isoformat()
+    }
+
+    # Versions are immutable, an identical model only refreshes the latest alias
+    reused = s3_io.exists(client, bucket, prefix+VERSION_FILE)
+    metrics.set_property("model_reused", reused)
+
+    with metrics.timer("S3UploadTime"):
+        if not reused:
+            s3_io.write_bytes(client, bucket, prefix+filename, model_bytes)
+            metrics.count("BytesUploaded", len(model_bytes), instrumentation.BYTES)
+            for name, local_path in files.items():
+                s3_io.upload_file(client, local_path, bucket, prefix+name)
+                metrics.count("BytesUploaded", os.path.getsize(local_path), instrumentation.BYTES)
+            for name, body in (extra_files or {}).items():
+                s3_io.write_bytes(client, bucket, prefix+name, body)
+            # written last, its presence marks a complete version
+            s3_io.write_bytes(client, bucket, prefix+VERSION_FILE, json.dumps(version, indent=2).encode())
+
+        if on_version is not None:
+            on_version(prefix+filename, model_hash)
+
+        # latest/ is a server side copy of the version, nothing is uploaded twice.
+        # The extra files describe this run (e.g. its leaderboard) so they are
+        # written to latest/ even when the model itself was reused.
+        for name in [filename] + list(files) + [VERSION_FILE]:
+            s3_io.copy(client, bucket, prefix+name, latest_prefix+name)
+        for name, body in (extra_files or {}).items():
+            s3_io.write_bytes(client, bucket, latest_prefix+name, body)
+
+    return prefix+filename, model_hash
+
+
+def reset_watermark(s3, bucket):
+    # on_version of full and search runs, the next incremental run merges every
+    # partition onto the new model instead of onto the previous incremental lineage
+    return lambda path, model_hash: incremental.reset_watermark(s3.meta.client, bucket, path, model_hash)
+
+
+def training_result(s3, bucket, model_path, model_hash, **extra):
+    # model_hash and in_use_hash drive the skip-if-unchanged Choice of the state machine
+    in_use_hash = read_in_use_hash(s3, bucket)
+    result = {
+        "model_path": model_path,
+        "model_hash": model_hash,
+        "in_use_hash": in_use_hash,
+        "changed": model_hash != in_use_hash
+    }
+    result.update(extra)
+    return result
+
+
+def search_handler(s3, bucket, iris, data_fingerprint, event, context):
+    # Cross validated grid search, the grid comes from the Step Functions input:
+    # {"search": {"n_neighbors": [...], "weights": [...], "metric": [...], "folds": 5,
+    #             "sample_rows": 200000}}
+    spec = event["search"]
+    grid = search.parse_grid(spec)
+    classes, y = np.unique(iris.Species.to_numpy(), return_inverse=True)
+    X = iris[FEATURE_COLUMNS].to_numpy(dtype=np.float64)
+
+    deadline = None
+    if context is not None:
+        deadline = time.monotonic() + context.get_remaining_time_in_millis() / 1000 - SEARCH_RESERVE_SECONDS
+
+    # Very large data sets are searched on a stratified sample, the winner is refit
+    # on everything. Without a sample_rows the sample is sized to the time left.
+    folds = int(spec.get("folds", 5))
+    sample_rows = spec.get("sample_rows")
+    if sample_rows is None and deadline is not None:
+        sample_rows = search.budget_sample_rows(X, grid, folds, deadline - time.monotonic(), n_jobs=spec.get("n_jobs"))
+    sample = search.stratified_sample(y, sample_rows)
+    metrics.set_property("sample_rows", int(len(sample)))
+    with metrics.timer("SearchTime"):
+        result = search.cross_validate(X[sample], y[sample], grid, folds=folds,
+            n_jobs=spec.get("n_jobs"), deadline=deadline)
+    if not result["leaderboard"]:
+        raise Exception("hyperparameter search ran out of time before any configuration was scored")
+
+    best = result["leaderboard"][0]
+    metrics.set_property("best_params", best["params"])
+    metrics.put("Accuracy", best["mean_accuracy"], "None")
+    metrics.count("ConfigurationsSkipped", result["skipped"])
+
+    model=KNeighborsClassifier(**best["params"])
+    with metrics.timer("FitTime"):
+        model.fit(iris[FEATURE_COLUMNS], iris.Species)
+
+    leaderboard = dict(result, grid=grid, classes=classes.tolist())
+    path, model_hash = upload_model(s3, bucket, model, iris[FEATURE_COLUMNS], iris.Species, event, data_fingerprint,
+        extra_files={"leaderboard.json": json.dumps(leaderboard, indent=2).encode()},
+        on_version=reset_watermark(s3, bucket))
+    return training_result(s3, bucket, path, model_hash, best=best, skipped=result["skipped"])
+
+
+def incremental_handler(s3, bucket, event):
+    # Appends the partitions that arrived under the prefix since the watermark to
+    # the reference set of the model the watermark was written with instead of
+    # refitting from all history:
+    # {"incremental": {"prefix": "data/incremental/"}}
+    spec = event["incremental"]
+    prefix = spec.get("prefix", incremental.DEFAULT_PREFIX)
+    client = s3.meta.client
+
+    watermark = incremental.read_watermark(client, bucket)
+    keys = incremental.list_new_partitions(client, bucket, prefix, watermark["last_key"])
+    metrics.count("PartitionsAdded", len(keys))
+    if not keys:
+        # nothing to merge, report the current model so that the pipeline sees no change
+        latest = read_version(s3, bucket, "models/latest/")
+        model_hash = latest["model_hash"] if latest else read_in_use_hash(s3, bucket)
+        path = "models/"+model_hash+"/finalized_model.sav" if model_hash else None
+        return training_result(s3, bucket, path, model_hash)
+
+    with metrics.timer("S3DownloadTime"):
+        new_X, new_y = incremental.read_partitions(client, bucket, keys, FEATURE_COLUMNS)
+
+        # a retry after a failed watermark write starts from the same parent again,
+        # so no partition is appended twice
+        parent_prefix = incremental.parent_prefix(watermark)
+        previous_dir = '/tmp/previous_artifact'
+        shutil.rmtree(previous_dir, ignore_errors=True)
+        manifest = incremental.download_artifact(client, bucket, parent_prefix+"artifact/", previous_dir)
+    if manifest is None:
+        raise Exception("no model artifact under "+parent_prefix+"artifact/, run a full training first")
+    previous = model_artifact.load_artifact(previous_dir)
+    parent_version = read_version(s3, bucket, parent_prefix)
+    X, y = incremental.append_rows(previous, new_X, new_y)
+
+    params = {"n_neighbors": manifest["n_neighbors"], "weights": manifest["weights"], "metric": manifest["metric"]}
+    model=KNeighborsClassifier(**params)
+    with metrics.timer("FitTime"):
+        model.fit(X, y)
+
+    lineage = {
+        # no parent path means the parent artifact has no version.json
+        "parent": "models/"+parent_version["model_hash"]+"/finalized_model.sav" if parent_version else None,
+        "parent_features_sha256": manifest["files"][model_artifact.FEATURES_FILE],
+        "parent_rows": manifest["n_samples"],
+        "added_partitions": keys,
+        "added_rows": int(len(new_y)),
+        "rows": int(len(y)),
+        "created_at": datetime.datetime.now().isoformat()
+    }
+    metrics.count("RowsProcessed", len(new_y))
+    metrics.set_property("reference_rows", int(len(y)))
+
+    # rebuild the neighbour index too when the previous version had one
+    event = dict(event, index_type=event.get("index_type", manifest.get("index")))
+    # the data is the parent reference set plus exactly these partition versions
+    data_fingerprint = hashlib.sha256(json.dumps({
+        "parent": manifest["files"],
+        "partitions": incremental.partition_etags(client, bucket, keys)
+    }, sort_keys=True).encode()).hexdigest()
+
+    def advance_watermark(path, model_hash):
+        # before latest/ is replaced, until then a retry starts from the same parent
+        incremental.write_watermark(client, bucket, {
+            "last_key": keys[-1],
+            "partitions": watermark["partitions"] + len(keys),
+            "rows": watermark["rows"] + int(len(new_y)),
+            "model_path": path,
+            "model_hash": model_hash
+        })
+
+    path, model_hash = upload_model(s3, bucket, model, X, y, event, data_fingerprint,
+        extra_files={"lineage.json": json.dumps(lineage, indent=2).encode()},
+        artifact_extra={"lineage": lineage}, on_version=advance_watermark)
+    return training_result(s3, bucket, path, model_hash, lineage=lineage)
+
 
 def handler(event, context):
-    s3 = boto3.resource('s3')
+    metrics.begin()
+    try:
+        result = _handle(event or {}, context)
+        metrics.set_dimension("ModelVersion", result["model_hash"] or "none")
+        return result
+    finally:
+        metrics.flush()
+
+
+def _handle(event, context):
+    s3 = s3_io.resource()
     bucket="cdk-ml-pipeline-iris"
     key="data/Iris.csv"
-    s3.Bucket(bucket).download_file(key, "/tmp/Iris.csv")
 
-    iris = pd.read_csv("/tmp/Iris.csv")
+    if "incremental" in event:
+        return incremental_handler(s3, bucket, event)
+
+    # read straight into memory, there is no /tmp round trip
+    with metrics.timer("S3DownloadTime"):
+        body = s3_io.read_bytes(s3.meta.client, bucket, key)
+    metrics.count("BytesDownloaded", len(body), instrumentation.BYTES)
 
-    train, test = train_test_split(iris, test_size = 0.3)
+    with metrics.timer("CsvParseTime"):
+        iris = pd.read_csv(io.BytesIO(body))
+    metrics.count("RowsProcessed", len(iris))
+    data_fingerprint = hashlib.sha256(body).hexdigest()
+
+    if "search" in event:
+        return search_handler(s3, bucket, iris, data_fingerprint, event, context)
+
+    # a fixed seed keeps the split, and so the model, identical while the data is unchanged
+    train, test = train_test_split(iris, test_size = 0.3, random_state=event.get("random_state", 0))
     # in this our main data is split into train and test
     # the attribute test_size=0.3 splits the data into 70% and 30% ratio. train=70% and test=30%
 
@@ -26,18 +301,12 @@ def handler(event, context):
     test_y =test.Species   #output value of test data
 
     model=KNeighborsClassifier(n_neighbors=3) #this examines 3 neighbours for putting the new data into a class
-    model.fit(train_X,train_y)
-    prediction=model.predict(test_X)
-    print('The accuracy of the KNN is',metrics.accuracy_score(prediction,test_y))
-
-    filename='finalized_model.sav'
-    pickle.dump(model, open('/tmp/finalized_model.sav', 'wb'))
-
-    t = datetime.datetime.now()
-    path="models/"+t.strftime('%m-%d-%Y %H-%M-%S')+"/"+filename
-    latest_path="models/"+"latest/"+filename
-
-    s3.Bucket(bucket).upload_file('/tmp/finalized_model.sav', path)
-    s3.Bucket(bucket).upload_file('/tmp/finalized_model.sav', latest_path)
+    with metrics.timer("FitTime"):
+        model.fit(train_X,train_y)
+    with metrics.timer("PredictTime"):
+        prediction=model.predict(test_X)
+    metrics.put("Accuracy", accuracy_score(prediction,test_y), "None")
 
-    print("Successfully uploaded trained model to S3 "+bucket)
+    path, model_hash = upload_model(s3, bucket, model, train_X, train_y, event, data_fingerprint,
+        on_version=reset_watermark(s3, bucket))
+    return training_result(s3, bucket, path, model_hash)